@@ -0,0 +1,236 @@
+"""账单合并工具性能基准
+
+用法:
+    python benchmark.py import     # 检查导入耗时与重量级依赖是否被提前加载
+    python benchmark.py pipeline   # 对比顺序执行与流水线执行的端到端耗时
+    python benchmark.py batch      # 对比单进程与多进程批处理多个账户的耗时
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import contextlib
+import subprocess
+import tempfile
+
+TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 导入merge_bills时不允许加载的模块
+HEAVY_MODULES = ['pandas', 'numpy', 'openpyxl', 'xlsxwriter']
+
+# 只在批处理或命令行解析时使用、导入merge_bills时不应加载的标准库模块
+DEFERRED_MODULES = ['multiprocessing', 'concurrent.futures', 'argparse']
+
+# 导入耗时上限（毫秒），超过即视为回退
+IMPORT_BUDGET_MS = 60
+
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)\s*$')
+
+ALIPAY_ONLY_SCRIPT = '''
+import os, sys
+import merge_bills
+df = merge_bills.read_alipay_bill(sys.argv[1])
+merged = merge_bills.merge_bills(None, df)
+merge_bills.save_single_file(merged, sys.argv[2])
+print('OPENPYXL_LOADED=%s' % ('openpyxl' in sys.modules))
+'''
+
+
+def run_python(args, cwd=TOOL_DIR):
+    """在独立解释器中运行，避免当前进程的模块缓存影响结果"""
+    return subprocess.run([sys.executable] + args, cwd=cwd, capture_output=True, text=True, encoding='utf-8')
+
+
+def parse_importtime(stderr):
+    """解析 -X importtime 输出，返回 {模块名: 累计耗时(微秒)}"""
+    timings = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            timings[match.group(3)] = int(match.group(2))
+    return timings
+
+
+def write_alipay_sample(file_path, rows=50, month='2024-01'):
+    """生成一个最小的支付宝账单CSV（GBK编码）"""
+    header = '交易时间,交易分类,交易对方,对方账号,商品说明,收/支,金额,收/付款方式,交易状态,交易订单号,商家订单号,备注'
+    lines = ['支付宝交易明细', '-' * 40, header]
+    for i in range(rows):
+        lines.append(f'{month}-{i % 28 + 1:02d} 12:{i % 60:02d}:00,餐饮美食,商户{i % 7},,商品{i},支出,{i + 0.5:.2f},余额宝,交易成功,{i:020d},,')
+    lines.append('-' * 40)
+    with open(file_path, 'w', encoding='gbk') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_wechat_sample(file_path, rows=50, month='2024-01'):
+    """生成一个微信账单xlsx：前16行为说明，第17行为表头"""
+    import pandas as pd
+    import merge_bills
+
+    records = []
+    for i in range(rows):
+        records.append([f'{month}-{i % 28 + 1:02d} 09:{i % 60:02d}:00', '商户消费', f'商户{i % 11}', f'商品{i}',
+                        '支出' if i % 5 else '收入', f'¥{i + 0.25:.2f}', '零钱', '支付成功', f'{i:028d}', '', '/'])
+    df = pd.DataFrame(records, columns=merge_bills.CONFIG['wechat_columns'])
+    df.to_excel(file_path, index=False, startrow=16)
+
+
+def month_sequence(count, start_year=2024):
+    """生成连续的月份字符串，如 ['2024-01', '2024-02', ...]"""
+    return [f'{start_year + i // 12}-{i % 12 + 1:02d}' for i in range(count)]
+
+
+def bench_import():
+    """检查导入耗时，以及仅有支付宝账单时不加载openpyxl"""
+    failures = []
+
+    result = run_python(['-X', 'importtime', '-c', 'import merge_bills'])
+    if result.returncode != 0:
+        print(result.stderr)
+        return 1
+    timings = parse_importtime(result.stderr)
+    total_ms = timings.get('merge_bills', 0) / 1000
+    print(f"merge_bills导入耗时: {total_ms:.1f}ms（上限{IMPORT_BUDGET_MS}ms）")
+    if total_ms > IMPORT_BUDGET_MS:
+        failures.append(f"导入耗时超出上限: {total_ms:.1f}ms")
+    loaded = [name for name in HEAVY_MODULES if name in timings]
+    if loaded:
+        failures.append(f"导入时加载了重量级依赖: {', '.join(loaded)}")
+    deferred = [name for name in DEFERRED_MODULES if name in timings]
+    if deferred:
+        failures.append(f"导入时加载了仅批处理使用的模块: {', '.join(deferred)}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, '支付宝交易明细.csv')
+        write_alipay_sample(csv_file)
+        result = run_python(['-c', ALIPAY_ONLY_SCRIPT, csv_file, tmp_dir])
+        if 'OPENPYXL_LOADED=False' in result.stdout:
+            print("仅支付宝账单: 未加载openpyxl")
+        else:
+            failures.append("仅支付宝账单的处理路径加载了openpyxl")
+            print(result.stdout[-2000:])
+            print(result.stderr[-2000:])
+
+    for failure in failures:
+        print(f"✗ {failure}")
+    if not failures:
+        print("✓ 导入基准通过")
+    return 1 if failures else 0
+
+
+def bench_pipeline(months=6, rows=2000):
+    """对比顺序执行与流水线执行的端到端耗时"""
+    import pandas as pd
+    import merge_bills
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for month in month_sequence(months):
+            period = month.replace('-', '')
+            write_wechat_sample(os.path.join(tmp_dir, f'微信支付账单({period}01-{period}28).xlsx'), rows, month)
+            write_alipay_sample(os.path.join(tmp_dir, f'支付宝交易明细({period}01-{period}28).csv'), rows, month)
+        wechat_files, alipay_files = merge_bills.find_bill_files(tmp_dir)
+
+        sequential_dir = os.path.join(tmp_dir, 'sequential')
+        pipeline_dir = os.path.join(tmp_dir, 'pipeline')
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            wechat_frames = [merge_bills.read_wechat_bill(f) for f in wechat_files]
+            alipay_frames = [merge_bills.read_alipay_bill(f) for f in alipay_files]
+            merged = merge_bills.merge_bills(pd.concat(wechat_frames, ignore_index=True),
+                                             pd.concat(alipay_frames, ignore_index=True))
+            merge_bills.save_by_month(merged, sequential_dir)
+            sequential_total = time.perf_counter() - started
+
+            _, _, pipelined, timings = merge_bills.run_pipeline(wechat_files, alipay_files, pipeline_dir)
+
+        settings = merge_bills.CONFIG['pipeline']
+        print(f"输入: {months}个月，每月微信/支付宝各{rows}条")
+        print(f"顺序执行端到端耗时: {sequential_total:.2f}秒")
+        print(f"流水线端到端耗时: {timings['total']:.2f}秒"
+              f"（读取线程{settings['read_workers']}，导出线程{settings['export_workers']}）")
+        print(f"流水线首个账单写出: {timings['first_export']:.2f}秒")
+
+        failures = []
+        if len(pipelined) != len(merged):
+            failures.append(f"流水线记录数{len(pipelined)}与顺序执行{len(merged)}不一致")
+        if abs(pipelined['收支金额'].sum() - merged['收支金额'].sum()) >= 0.01:
+            failures.append("流水线收支金额总和与顺序执行不一致")
+        if sorted(os.listdir(pipeline_dir)) != sorted(os.listdir(sequential_dir)):
+            failures.append("流水线导出的文件与顺序执行不一致")
+
+    for failure in failures:
+        print(f"✗ {failure}")
+    if not failures:
+        print("✓ 流水线基准通过")
+    return 1 if failures else 0
+
+
+def bench_batch(accounts=4, months=3, rows=2000, workers=None):
+    """对比单进程与多进程批处理多个账户的耗时"""
+    import merge_bills
+
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        entries = []
+        for i in range(accounts):
+            input_dir = os.path.join(tmp_dir, f'account{i}')
+            os.makedirs(input_dir)
+            for month in month_sequence(months):
+                period = month.replace('-', '')
+                write_wechat_sample(os.path.join(input_dir, f'微信支付账单({period}01-{period}28).xlsx'), rows, month)
+                write_alipay_sample(os.path.join(input_dir, f'支付宝交易明细({period}01-{period}28).csv'), rows, month)
+            entries.append({'name': f'账户{i + 1}', 'input_dir': input_dir, 'export_mode': 'month'})
+
+        results = {}
+        for count in sorted({1, workers}):
+            accounts_for_run = [dict(entry, output_dir=os.path.join(tmp_dir, f'out{count}', f'account{i}'))
+                                for i, entry in enumerate(entries)]
+            with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+                results[count] = merge_bills.run_batch(accounts_for_run, count)
+
+    print(f"输入: {accounts}个账户，每个账户{months}个月，每月微信/支付宝各{rows}条")
+    for count, (report, elapsed) in results.items():
+        merge_seconds = sum(row['合并耗时(秒)'] for row in report)
+        print(f"{count}个进程: 总耗时{elapsed:.2f}秒，合并阶段累计{merge_seconds:.2f}秒")
+    if workers > 1:
+        print(f"加速比: {results[1][1] / results[workers][1]:.2f}（{workers}个进程）")
+    else:
+        print("当前机器只有1个CPU核心，可用 --workers 指定进程数对比")
+
+    failures = []
+    for count, (report, _) in results.items():
+        failed = [row['账户'] for row in report if row['状态'] != '成功']
+        if failed:
+            failures.append(f"{count}个进程时以下账户未成功: {', '.join(failed)}")
+    records = {count: [row['记录数'] for row in report] for count, (report, _) in results.items()}
+    if len({tuple(value) for value in records.values()}) > 1:
+        failures.append("不同进程数的记录数不一致")
+
+    for failure in failures:
+        print(f"✗ {failure}")
+    if not failures:
+        print("✓ 批处理基准通过")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='账单合并工具性能基准')
+    parser.add_argument('suite', choices=['import', 'pipeline', 'batch'], help='要运行的基准')
+    parser.add_argument('--months', type=int, default=6, help='pipeline/batch基准生成的月份数')
+    parser.add_argument('--rows', type=int, default=2000, help='pipeline/batch基准每个文件的记录数')
+    parser.add_argument('--accounts', type=int, default=4, help='batch基准的账户数')
+    parser.add_argument('--workers', type=int, default=None, help='batch基准的进程数，默认为CPU核心数')
+    args = parser.parse_args()
+
+    if args.suite == 'import':
+        return bench_import()
+    if args.suite == 'pipeline':
+        return bench_pipeline(args.months, args.rows)
+    if args.suite == 'batch':
+        return bench_batch(args.accounts, args.months, args.rows, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
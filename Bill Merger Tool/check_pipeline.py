@@ -0,0 +1,955 @@
+"""账单处理流程的等价性与性能回归检查
+
+随机生成包含各类边界情况的微信/支付宝账单（金额缺失、￥与千分位格式、STATUS_MAPPING中的各种状态、
+空行、列数不足的行、不成对的引号、结尾统计行等），检查：
+
+- 读取、合并和完整性验证与最初版本逐行处理的实现（本文件中的reference_*函数）结果一致，
+  有意改变的行为逐条列在INTENDED_DIFFERENCES中；
+- 交易对方规范化、转账与退款对账与逐对比较的参考实现结果一致；
+- 导出的Excel与最初版本的导出实现逐个单元格一致（值、数字格式、列宽、冻结和筛选）；
+- 流水线执行（run_pipeline）与顺序执行得到相同的合并数据和相同的各月账单；
+- 各阶段在固定规模的输入上不超出耗时预算。
+
+用法:
+    python check_pipeline.py                  # 等价性检查 + 性能检查
+    python check_pipeline.py --seeds 50       # 增加随机用例数量
+    python check_pipeline.py --skip-perf      # 只做等价性检查
+    python check_pipeline.py --budget-scale 2 # 在较慢的机器上放宽耗时预算
+"""
+import os
+import io
+import re
+import csv
+import sys
+import time
+import random
+import argparse
+import warnings
+import contextlib
+import tempfile
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import pandas as pd
+import openpyxl
+import xlsxwriter
+
+import merge_bills
+
+# 逐个推断日期格式时pandas给出的提示与检查结果无关
+warnings.filterwarnings('ignore', message='Could not infer format')
+
+# 各阶段在固定规模输入上的耗时预算（秒）
+PERF_CASES = {
+    'read_alipay_bill': {'rows': 20000, 'budget': 3.0},
+    'read_wechat_bill': {'rows': 5000, 'budget': 5.0},
+    'merge_bills': {'rows': 40000, 'budget': 2.0},
+    'validate_merge_integrity': {'rows': 40000, 'budget': 0.5},
+    'normalize_counterparties': {'rows': 40000, 'budget': 2.0},
+    'reconcile_transactions': {'rows': 40000, 'budget': 1.0},
+    'save_single_file': {'rows': 40000, 'budget': 8.0}
+}
+
+# 当前实现与最初版本有意不同的行为；参考实现按最初版本处理，只在这里列出的差异上按当前行为调整
+INTENDED_DIFFERENCES = {
+    'alipay_fullwidth_yuan': '支付宝金额中的全角"￥"被去除后解析（最初版本只去除半角"¥"，GBK账单中带￥的金额按0计入）',
+    'alipay_stop_at_footer': '支付宝账单读到结尾分隔线即停止（最初版本跳过分隔线，把其后列数足够的统计行也当作交易记录）'
+}
+
+# 参与对比的列
+COMPARE_COLUMNS = merge_bills.CONFIG['merged_columns'] + ['交易单号', '商户单号/商家订单号', '备注', '来源']
+
+ALIPAY_HEADER = ['交易时间', '交易分类', '交易对方', '对方账号', '商品说明', '收/支', '金额',
+                 '收/付款方式', '交易状态', '交易订单号', '商家订单号', '备注']
+
+STATUS_VARIANTS = ([variant for variants in merge_bills.STATUS_MAPPING.values() for variant in variants] +
+                   ['退款', '交易关闭', '已全额退款', ' 交易成功 ', '等待付款'])
+
+ACCOUNTING_NUM_FORMAT = '_([$¥-804]* #,##0.00_);_([$¥-804]* -#,##0.00_);_([$¥-804]* "-"??_);_(@_)'
+
+RECONCILE_COLUMNS = ['交易时间', '交易类型', '交易对方', '商品/商品名称', '收/支', '金额', '交易状态', '来源']
+
+
+# ---------------------------------------------------------------------------
+# 随机账单生成
+# ---------------------------------------------------------------------------
+
+def random_moment(rng, start, days, stray_days=0):
+    """start之后days天内的随机时刻；stray_days大于0时少量时刻落在该区间前后stray_days天内"""
+    if stray_days and rng.random() < 0.05:
+        offset = rng.choice([-1, 1]) * rng.uniform(0, stray_days) + (days if rng.random() < 0.5 else 0)
+    else:
+        offset = rng.uniform(0, days)
+    return start + timedelta(seconds=int(offset * 86400))
+
+
+def random_time_text(rng, moment):
+    """随机格式的交易时间，少量为无效值"""
+    choice = rng.random()
+    if choice < 0.05:
+        return ''
+    if choice < 0.08:
+        return rng.choice(['N/A', '未知时间', '2024-13-45 99:00:00'])
+    if choice < 0.2:
+        return moment.strftime('%Y/%m/%d %H:%M')
+    if choice < 0.3:
+        return ' ' + moment.strftime('%Y-%m-%d %H:%M:%S') + ' '
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def random_amount_text(rng, currency):
+    """随机格式的金额：普通数值、货币符号、千分位、缺失和无效值"""
+    value = round(rng.uniform(0.01, 20000), 2)
+    choice = rng.random()
+    if choice < 0.05:
+        return ''
+    if choice < 0.08:
+        return rng.choice(['abc', '--', '免费'])
+    if choice < 0.1:
+        return '0.00'
+    if choice < 0.3:
+        return f'{currency}{value:.2f}'
+    if choice < 0.45:
+        return f'{value:,.2f}'
+    if choice < 0.55:
+        return f'{currency}{value:,.2f}'
+    return f'{value:.2f}'
+
+
+def random_counterparty(rng):
+    return rng.choice(['美团', '美团外卖(北京)', '美团外卖（上海）', '星巴克', 'Starbucks, Inc', 'STARBUCKS',
+                       '星巴克咖啡北京国贸商城一店', '星巴克咖啡北京国贸商城二店', '张三', '"引号"商户', '滴滴出行',
+                       '中国移动有限公司', '中国移动', '/', ''])
+
+
+def generate_alipay_text(rng, rows, start=datetime(2024, 1, 1), days=60, stray_days=0):
+    """生成支付宝账单CSV文本，包含空行、列数不足和列数过多的行、不成对的引号，以及结尾的分隔线和统计行"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    end = start + timedelta(days=days) - timedelta(seconds=1)
+    buffer.write('支付宝交易明细\n')
+    buffer.write(f"起始时间：[{start:%Y-%m-%d %H:%M:%S}]    终止时间：[{end:%Y-%m-%d %H:%M:%S}]\n")
+    buffer.write('-' * 40 + '\n')
+    writer.writerow(ALIPAY_HEADER)
+    for i in range(rows):
+        choice = rng.random()
+        if choice < 0.04:
+            buffer.write('\n')
+            continue
+        if choice < 0.07:
+            writer.writerow(['列数不足', str(i)])
+            continue
+        if 0.1 <= choice < 0.14:
+            # 不成对的引号：字段开头未闭合的引号吞掉本行其余的列，字段中间的引号按普通字符处理
+            counterparty = rng.choice(['"未闭合引号商户', '半个"引号商户', '"引号"后缀商户', '商户"'])
+            fields = [f'{random_moment(rng, start, days):%Y-%m-%d %H:%M:%S}', '餐饮美食', counterparty, '',
+                      f'商品{i}', '支出', f'{rng.uniform(0.01, 500):.2f}', '余额宝', '交易成功', f'{i:020d}', f'M{i}', '']
+            buffer.write(','.join(fields) + '\n')
+            continue
+        row = [random_time_text(rng, random_moment(rng, start, days, stray_days)),
+               rng.choice(['餐饮美食', '转账红包', '日用百货', ' 退款 ']),
+               random_counterparty(rng), '', f'商品{i}', rng.choice(['支出', '收入', '不计收支', '']),
+               random_amount_text(rng, '￥'), '余额宝', rng.choice(STATUS_VARIANTS), f'{i:020d}', f'M{i}',
+               rng.choice(['', '备注', ' 有空格 '])]
+        if choice < 0.1:
+            row.append('多余的列')
+        writer.writerow(row)
+    buffer.write('-' * 40 + '\n')
+    buffer.write(f'共{rows}笔记录\n')
+    if rng.random() < 0.5:
+        # 分隔线之后列数足够的统计行
+        writer.writerow(['导出信息', '收入笔数', str(rows), '', '', '', '', '', '', '', '', ''])
+    return buffer.getvalue()
+
+
+def generate_wechat_frame(rng, rows, start=datetime(2024, 1, 1), days=60, stray_days=0):
+    """生成微信账单数据（写入xlsx时前16行为说明，第17行为表头）"""
+    records = []
+    for i in range(rows):
+        moment = random_moment(rng, start, days, stray_days)
+        choice = rng.random()
+        if choice < 0.05:
+            trade_time = None
+        elif choice < 0.5:
+            trade_time = moment
+        else:
+            trade_time = random_time_text(rng, moment)
+        amount = random_amount_text(rng, '¥')
+        records.append([trade_time, rng.choice(['商户消费', '转账', '微信红包', '美团-退款']), random_counterparty(rng),
+                        f'商品{i}', rng.choice(['支出', '收入', '/']), amount if amount != '' else None, '零钱',
+                        rng.choice(STATUS_VARIANTS), f'{i:028d}', rng.choice(['', f'M{i}']), '/'])
+    return pd.DataFrame(records, columns=merge_bills.CONFIG['wechat_columns'])
+
+
+def generate_reconcile_frame(rng, rows, start=datetime(2024, 1, 1), days=10):
+    """生成用于对账检查的合并账单：交易对方和金额取值少、时间按整点取值，转账、退款记录大量成组出现并有同时刻的记录"""
+    records = []
+    for _ in range(rows):
+        trade_time = start + timedelta(hours=rng.randrange(days * 24)) if rng.random() >= 0.03 else None
+        records.append([trade_time, rng.choice(['商户消费', '转账', '零钱提现', '美团-退款', '退款', '餐饮美食']),
+                        rng.choice(['美团', '滴滴出行', '张三']), rng.choice(['外卖订单', '充值', '退款-外卖订单', '']),
+                        rng.choice(['支出', '收入', '/']), rng.choice([0.0, 10.0, 35.5, 88.0, 200.0]),
+                        rng.choice(STATUS_VARIANTS), rng.choice(['微信', '支付宝'])])
+    return reconcile_frame(records)
+
+
+def reconcile_frame(rows):
+    """用给定记录构造对账所需的合并账单"""
+    df = pd.DataFrame(rows, columns=RECONCILE_COLUMNS)
+    df['交易时间'] = pd.to_datetime(df['交易时间'])
+    df['收支金额'] = df['金额'].where(df['收/支'] != '支出', -df['金额'])
+    return df
+
+
+def random_merchant_names(rng, count):
+    """生成count个不同的商户名称，用于规范化的性能检查"""
+    chars = '美团滴出行星巴克咖啡中国移动联通电信京东淘宝天猫拼多多饿了么肯德基麦当劳全家罗森便利超市华润万家永辉盒马'
+    names = set()
+    while len(names) < count:
+        names.add(''.join(rng.choice(chars) for _ in range(rng.randint(3, 8))))
+    return sorted(names)
+
+
+def write_alipay_file(file_path, text):
+    with open(file_path, 'w', encoding='gbk') as f:
+        f.write(text)
+
+
+def write_wechat_file(file_path, df):
+    df.to_excel(file_path, index=False, startrow=16)
+
+
+# ---------------------------------------------------------------------------
+# 参考实现：最初版本的逐行处理逻辑，只在INTENDED_DIFFERENCES列出的行为上调整
+# ---------------------------------------------------------------------------
+
+def reference_standardize_status(status):
+    status = str(status).strip()
+    if status == '退款':
+        return '退款'
+    for standard, variations in merge_bills.STATUS_MAPPING.items():
+        if status in variations:
+            return standard
+    return status
+
+
+def reference_extract_month(date_str):
+    """从日期字符串中提取月份"""
+    if pd.isna(date_str):
+        return None
+
+    try:
+        if isinstance(date_str, datetime):
+            return date_str.strftime('%Y-%m')
+        date = pd.to_datetime(date_str)
+        return date.strftime('%Y-%m')
+    except Exception:
+        match = re.search(r'\d{4}[-/]?(1[0-2]|0?[1-9])', str(date_str))
+        if match:
+            year = match.group(0)[:4]
+            month = match.group(1).zfill(2)
+            return f"{year}-{month}"
+        return None
+
+
+def reference_read_alipay(file_path, differences=INTENDED_DIFFERENCES):
+    """逐行解析支付宝账单：每行单独用csv解析，每条记录单独解析时间和金额"""
+    with open(file_path, 'r', encoding='gbk') as f:
+        lines = f.readlines()
+    header_index = next(i for i, line in enumerate(lines) if '交易时间' in line)
+
+    data_rows = []
+    for line in lines[header_index + 1:]:
+        line = line.strip()
+        if line.startswith('----') or line.startswith('"----'):
+            if 'alipay_stop_at_footer' in differences:
+                break
+            continue
+        if line:
+            data_rows.append(next(csv.reader(io.StringIO(line))))
+
+    records = []
+    for row in data_rows:
+        if len(row) < 12:
+            continue
+        amount_str = row[6].strip().replace('¥', '').replace(',', '')
+        if 'alipay_fullwidth_yuan' in differences:
+            amount_str = amount_str.replace('￥', '')
+        amount = pd.to_numeric(amount_str, errors='coerce')
+        records.append({
+            '交易时间': pd.to_datetime(row[0].strip(), errors='coerce'),
+            '交易类型': row[1].strip(),
+            '交易对方': row[2].strip(),
+            '商品/商品名称': row[4].strip(),
+            '收/支': row[5].strip(),
+            '金额': amount if not pd.isna(amount) else 0.0,
+            '支付方式': '支付宝',
+            '交易状态': row[8].strip(),
+            '交易单号': row[9].strip(),
+            '商户单号/商家订单号': row[10].strip(),
+            '备注': row[11].strip(),
+            '来源': '支付宝'
+        })
+    df = pd.DataFrame(records, columns=COMPARE_COLUMNS)
+    df['交易状态'] = df['交易状态'].apply(reference_standardize_status)
+    return df.dropna(subset=['交易时间', '交易类型', '交易对方'], how='all')
+
+
+def reference_read_wechat(file_path):
+    """读取微信账单：整列解析时间，逐条去除金额中的非数字字符，逐条标准化交易状态"""
+    df = pd.read_excel(file_path, skiprows=16)
+    df.columns = merge_bills.CONFIG['wechat_columns']
+    df['交易时间'] = pd.to_datetime(df['交易时间'], errors='coerce')
+    df['金额'] = df['金额'].astype(str).str.replace(r'[^\d.-]', '', regex=True)
+    df['金额'] = pd.to_numeric(df['金额'], errors='coerce').fillna(0.0)
+    df['当前状态'] = df['当前状态'].apply(reference_standardize_status)
+
+    mapped = pd.DataFrame(columns=COMPARE_COLUMNS)
+    for wechat_col, merged_col in merge_bills.COLUMN_MAPPING['wechat'].items():
+        mapped[merged_col] = df[wechat_col]
+    mapped['来源'] = '微信'
+    mapped['支付方式'] = '微信支付'
+    return mapped
+
+
+def reference_merge(wechat_df, alipay_df):
+    """合并、排序，逐行计算收支金额并提取月份"""
+    frames = [df for df in (wechat_df, alipay_df) if df is not None and not df.empty]
+    if not frames:
+        return None
+    merged_df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    merged_df = merged_df.sort_values('交易时间').reset_index(drop=True)
+
+    def calculate_income_expense(row):
+        if row['收/支'] == '支出':
+            return -row['金额']
+        return row['金额']
+
+    merged_df['收支金额'] = merged_df.apply(calculate_income_expense, axis=1)
+    merged_df['月份'] = merged_df['交易时间'].apply(reference_extract_month)
+    return merged_df
+
+
+def reference_validate(wechat_df, alipay_df, merged_df):
+    """验证合并前后的数据一致性（逐行计算预期收支金额），输出与返回值与当前实现逐字对比"""
+    print("\n=== 合并完整性验证 ===")
+
+    expected_records = 0
+    if wechat_df is not None:
+        expected_records += len(wechat_df)
+    if alipay_df is not None:
+        expected_records += len(alipay_df)
+
+    actual_records = len(merged_df)
+    print(f"预期记录数: {expected_records}")
+    print(f"实际记录数: {actual_records}")
+
+    if expected_records == actual_records:
+        print("✓ 记录数完全匹配")
+    else:
+        print(f"✗ 记录数不匹配，差异: {abs(expected_records - actual_records)}")
+
+    expected_amount = 0
+    if wechat_df is not None:
+        expected_amount += wechat_df['金额'].sum()
+    if alipay_df is not None:
+        expected_amount += alipay_df['金额'].sum()
+
+    actual_amount = merged_df['金额'].sum()
+    print(f"\n预期总金额: {expected_amount:.2f}")
+    print(f"实际总金额: {actual_amount:.2f}")
+
+    if abs(expected_amount - actual_amount) < 0.01:
+        print("✓ 总金额完全匹配")
+    else:
+        print(f"✗ 总金额不匹配，差异: {abs(expected_amount - actual_amount):.2f}")
+
+    def calculate_expected_income_expense(df):
+        if df is None:
+            return 0
+        expected_income_expense = 0
+        for _, row in df.iterrows():
+            if row['收/支'] == '支出':
+                expected_income_expense -= row['金额']
+            else:
+                expected_income_expense += row['金额']
+        return expected_income_expense
+
+    expected_income_expense = 0
+    if wechat_df is not None:
+        expected_income_expense += calculate_expected_income_expense(wechat_df)
+    if alipay_df is not None:
+        expected_income_expense += calculate_expected_income_expense(alipay_df)
+
+    actual_income_expense = merged_df['收支金额'].sum()
+    print(f"\n预期收支金额: {expected_income_expense:.2f}")
+    print(f"实际收支金额: {actual_income_expense:.2f}")
+
+    if abs(expected_income_expense - actual_income_expense) < 0.01:
+        print("✓ 收支金额完全匹配")
+    else:
+        print(f"✗ 收支金额不匹配，差异: {abs(expected_income_expense - actual_income_expense):.2f}")
+
+    if wechat_df is not None and alipay_df is not None:
+        expected_wechat = len(wechat_df)
+        expected_alipay = len(alipay_df)
+        actual_wechat = (merged_df['来源'] == '微信').sum()
+        actual_alipay = (merged_df['来源'] == '支付宝').sum()
+
+        print(f"\n预期微信记录: {expected_wechat}")
+        print(f"实际微信记录: {actual_wechat}")
+        print(f"预期支付宝记录: {expected_alipay}")
+        print(f"实际支付宝记录: {actual_alipay}")
+
+        if expected_wechat == actual_wechat and expected_alipay == actual_alipay:
+            print("✓ 来源分布完全匹配")
+        else:
+            print("✗ 来源分布不匹配")
+
+    return expected_records == actual_records and abs(expected_amount - actual_amount) < 0.01
+
+
+def reference_counterparty_key(name):
+    """交易对方的归一化键：全半角统一、忽略大小写，去掉括号内容、标点和公司后缀"""
+    text = unicodedata.normalize('NFKC', name).casefold()
+    key = re.sub(r'[\W_]+', '', re.sub(r'[(\[【].*?[)\]】]', '', text)) or re.sub(r'[\W_]+', '', text)
+    for suffix in merge_bills.CONFIG['counterparty']['strip_suffixes']:
+        if key.endswith(suffix) and len(key) > len(suffix):
+            return key[:-len(suffix)]
+    return key
+
+
+def reference_normalize_counterparties(*columns):
+    """逐个名称与全部已知商户两两比较的规范化，返回各列规范化后的名称列表
+
+    每列内按出现次数从多到少（次数相同时按首次出现）处理；归一化键已知时直接归入，
+    否则取数字相同、n-gram集合Dice相似度最高（相同时取最早的）且达到阈值的商户，
+    没有时新增商户，规范名称为去掉括号内容的原始写法。
+    """
+    settings = merge_bills.CONFIG['counterparty']
+    n = settings['ngram_size']
+
+    def grams(key):
+        return {key} if len(key) <= n else {key[i:i + n] for i in range(len(key) - n + 1)}
+
+    def numerals(key):
+        return re.findall(r'[\d〇零一二三四五六七八九十百千]+', key)
+
+    names, keys, key_index, memo = [], [], {}, {}
+    results = []
+    for values in columns:
+        counts = Counter(value for value in values if isinstance(value, str))
+        for name in sorted(counts, key=lambda value: -counts[value]):
+            key = reference_counterparty_key(name)
+            if not key:
+                memo[name] = name
+                continue
+            if key not in key_index:
+                best, best_score = None, 0.0
+                for idx, other in enumerate(keys):
+                    if numerals(other) != numerals(key):
+                        continue
+                    score = 2.0 * len(grams(key) & grams(other)) / (len(grams(key)) + len(grams(other)))
+                    if score > best_score:
+                        best, best_score = idx, score
+                if best is None or best_score < settings['similarity_threshold']:
+                    best = len(names)
+                    names.append(re.sub(r'\s*[(（\[【].*?[)）\]】]\s*', '', name).strip() or name.strip())
+                    keys.append(key)
+                key_index[key] = best
+            memo[name] = names[key_index[key]]
+        results.append([memo[value] if isinstance(value, str) else value for value in values])
+    return results
+
+
+def reference_reconcile(df):
+    """逐对比较的转账与退款对账，返回配对集合{(类别, (行号, 行号))}
+
+    每组记录按(时间, 侧, 行号)依次处理：转账记录与组内未配对的另一侧记录中最早且在窗口内的一笔配对；
+    退款记录与组内未配对、不晚于它且在窗口内的消费记录中最晚的一笔配对。
+    """
+    settings = merge_bills.CONFIG['reconcile']
+    rows = df.to_dict('records')
+    times = [pd.to_datetime(row['交易时间'], errors='coerce') for row in rows]
+    cents = []
+    for row in rows:
+        amount = pd.to_numeric(row['金额'], errors='coerce')
+        cents.append(0 if pd.isna(amount) else round(float(amount) * 100))
+    texts = [f"{row['交易类型']} {row['商品/商品名称']}" for row in rows]
+    expense = [row['收/支'] == '支出' for row in rows]
+    valid = [not pd.isna(times[i]) and cents[i] > 0 for i in range(len(rows))]
+
+    def pair_groups(members, group_key, side_of, window, ordered):
+        groups = defaultdict(list)
+        for i in members:
+            groups[group_key(i)].append(i)
+        pairs = []
+        for group in groups.values():
+            unmatched = []
+            for i in sorted(group, key=lambda i: (times[i], side_of(i), i)):
+                others = [j for j in unmatched if side_of(j) != side_of(i) and times[j] >= times[i] - window]
+                if ordered and side_of(i) == 0:
+                    unmatched.append(i)
+                elif others:
+                    other = others[-1] if ordered else others[0]
+                    unmatched.remove(other)
+                    pairs.append((other, i))
+                elif not ordered:
+                    unmatched.append(i)
+        return pairs
+
+    pairs = set()
+    tagged = set()
+    transfers = [i for i in range(len(rows)) if valid[i] and
+                 any(keyword in texts[i] for keyword in settings['transfer_keywords'])]
+    for a, b in pair_groups(transfers, lambda i: ((rows[i]['来源'] == '微信') == expense[i], cents[i]),
+                            lambda i: 0 if expense[i] else 1,
+                            timedelta(hours=settings['transfer_window_hours']), ordered=False):
+        if rows[a]['来源'] != rows[b]['来源']:
+            pairs.add(('跨平台转账', tuple(sorted((a, b)))))
+            tagged.update((a, b))
+
+    is_refund = [any(keyword in texts[i] for keyword in settings['refund_keywords']) for i in range(len(rows))]
+    refunds = [i for i in range(len(rows)) if valid[i] and i not in tagged and is_refund[i] != expense[i]]
+    for a, b in pair_groups(refunds, lambda i: (rows[i]['来源'], str(rows[i]['交易对方']), cents[i]),
+                            lambda i: 1 if is_refund[i] else 0,
+                            timedelta(days=settings['refund_window_days']), ordered=True):
+        pairs.add(('退款', tuple(sorted((a, b)))))
+    return pairs
+
+
+def reference_write_workbook(output_df, output_file, sheet_name, date_num_format, column_widths=None):
+    """用pandas.ExcelWriter写出数据，再为收支金额列逐行写入公式并设置格式"""
+    writer = pd.ExcelWriter(output_file, engine='xlsxwriter')
+    output_df.to_excel(writer, index=False, sheet_name=sheet_name)
+    workbook = writer.book
+    worksheet = writer.sheets[sheet_name]
+
+    num_rows = len(output_df)
+    num_cols = len(output_df.columns)
+    if column_widths:
+        for col_idx, col_name in enumerate(output_df.columns):
+            worksheet.set_column(col_idx, col_idx, column_widths.get(col_name, 15))
+
+    date_format = workbook.add_format({'num_format': date_num_format})
+    accounting_format = workbook.add_format({'num_format': ACCOUNTING_NUM_FORMAT})
+    worksheet.set_column(0, 0, 20, date_format)
+
+    amount_col = output_df.columns.get_loc('金额')
+    income_expense_col = output_df.columns.get_loc('收支金额')
+    type_col = output_df.columns.get_loc('收/支')
+    income_expense_col_letter = xlsxwriter.utility.xl_col_to_name(income_expense_col)
+    amount_col_letter = xlsxwriter.utility.xl_col_to_name(amount_col)
+    type_col_letter = xlsxwriter.utility.xl_col_to_name(type_col)
+
+    worksheet.set_column(amount_col, amount_col, 15, accounting_format)
+    worksheet.set_column(income_expense_col, income_expense_col, 15, accounting_format)
+
+    for row_num in range(1, num_rows + 1):
+        formula = f'=IF({type_col_letter}{row_num+1}="支出", -{amount_col_letter}{row_num+1}, {amount_col_letter}{row_num+1})'
+        worksheet.write_formula(row_num, income_expense_col, formula, accounting_format)
+
+    worksheet.freeze_panes(1, 0)
+    worksheet.autofilter(0, 0, num_rows, num_cols - 1)
+    subtotal_formula = f'=SUBTOTAL(9,{income_expense_col_letter}2:{income_expense_col_letter}{num_rows + 1})'
+    worksheet.write(num_rows + 1, income_expense_col, subtotal_formula, accounting_format)
+    writer.close()
+
+
+def reference_save(merged_df, output_dir):
+    """按最初版本的导出方式写出总账单和各月账单"""
+    def output_frame(df):
+        return df.drop(['月份', '来源'] + merge_bills.CONFIG['hidden_columns'], axis=1,
+                       errors='ignore')[merge_bills.CONFIG['merged_columns']]
+
+    reference_write_workbook(output_frame(merged_df), os.path.join(output_dir, '总账单.xlsx'), '合并账单', 'yyyy-mm-dd')
+    month_widths = {'交易时间': 20, '交易类型': 15, '交易对方': 25, '商品/商品名称': 30, '收/支': 8,
+                    '金额': 15, '收支金额': 15, '支付方式': 12, '交易状态': 12}
+    for month in merged_df['月份'].unique():
+        if month is not None:
+            month_df = merged_df[merged_df['月份'] == month]
+            output_file = os.path.join(output_dir, f"{merge_bills.month_str_to_chinese(month)}账单.xlsx")
+            reference_write_workbook(output_frame(month_df), output_file, '账单明细', 'yyyy-mm-dd hh:mm', month_widths)
+
+
+def reference_totals(df):
+    """逐行计算记录数、金额总和与收支金额总和"""
+    amount = 0.0
+    income_expense = 0.0
+    for kind, value in zip(df['收/支'], df['金额']):
+        amount += value
+        income_expense += -value if kind == '支出' else value
+    return len(df), amount, income_expense
+
+
+# ---------------------------------------------------------------------------
+# 对比
+# ---------------------------------------------------------------------------
+
+def normalize_value(value):
+    """将不同的缺失值与数值类型统一，便于比较"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return pd.Timestamp(value).to_pydatetime()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(float(value), 6)
+    return value
+
+
+def frame_differences(actual, expected, columns, sort_by=None):
+    """返回两个数据表在指定列上的差异描述，无差异时返回空列表"""
+    if len(actual) != len(expected):
+        return [f"记录数不同: {len(actual)} != {len(expected)}"]
+    if sort_by:
+        actual = actual.sort_values(sort_by, kind='mergesort')
+        expected = expected.sort_values(sort_by, kind='mergesort')
+    differences = []
+    for col in columns:
+        left = [normalize_value(value) for value in actual[col]]
+        right = [normalize_value(value) for value in expected[col]]
+        for i, (a, b) in enumerate(zip(left, right)):
+            if a != b:
+                differences.append(f"列{col}第{i}行不同: {a!r} != {b!r}")
+                break
+    return differences
+
+
+def workbook_snapshot(file_path):
+    """读取工作表的单元格（值与数字格式）和版式（表名、列宽、冻结窗格、筛选范围）"""
+    worksheet = openpyxl.load_workbook(file_path).active
+    rows = [tuple((cell.value, cell.number_format) for cell in row) for row in worksheet.iter_rows()]
+    widths = {letter: dimension.width for letter, dimension in worksheet.column_dimensions.items()}
+    layout = (worksheet.title, worksheet.freeze_panes, worksheet.auto_filter.ref, widths)
+    return rows, layout
+
+
+def workbook_differences(actual_file, expected_file, ignore_row_order=False):
+    """逐个单元格对比两个工作簿；ignore_row_order时数据行按内容排序后再对比，
+    收支金额公式只与所在行号有关，单独按位置对比"""
+    actual_rows, actual_layout = workbook_snapshot(actual_file)
+    expected_rows, expected_layout = workbook_snapshot(expected_file)
+    name = os.path.basename(actual_file)
+    if actual_layout != expected_layout:
+        return [f"{name}: 版式不同: {actual_layout} != {expected_layout}"]
+    if len(actual_rows) != len(expected_rows):
+        return [f"{name}: 行数不同: {len(actual_rows)} != {len(expected_rows)}"]
+    if ignore_row_order and len(actual_rows) > 2:
+        formula_col = merge_bills.CONFIG['merged_columns'].index('收支金额')
+
+        def split(rows):
+            data = rows[1:-1]
+            formulas = [row[formula_col] for row in data]
+            contents = sorted((tuple(map(repr, row[:formula_col] + row[formula_col + 1:])) for row in data))
+            return [rows[0], rows[-1], formulas], contents
+
+        actual_fixed, actual_contents = split(actual_rows)
+        expected_fixed, expected_contents = split(expected_rows)
+        if actual_fixed != expected_fixed or actual_contents != expected_contents:
+            return [f"{name}: 数据行内容不同"]
+        return []
+    for row_idx, (actual_row, expected_row) in enumerate(zip(actual_rows, expected_rows)):
+        if actual_row != expected_row:
+            return [f"{name}: 第{row_idx + 1}行不同: {actual_row} != {expected_row}"]
+    return []
+
+
+def tag_pairs(tags):
+    """把对账标记列转换为配对集合{(类别, (行号, ...))}，与编号无关"""
+    groups = defaultdict(list)
+    for pos, tag in enumerate(tags):
+        if tag:
+            groups[tag].append(pos)
+    return {(tag.split('#')[0], tuple(positions)) for tag, positions in groups.items()}
+
+
+@contextlib.contextmanager
+def configured(section, **values):
+    """临时修改CONFIG[section]中的配置项"""
+    settings = merge_bills.CONFIG[section]
+    saved = {name: settings[name] for name in values}
+    settings.update(values)
+    try:
+        yield
+    finally:
+        settings.update(saved)
+
+
+def captured(func, *args):
+    """执行func并返回(返回值, 标准输出内容)"""
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        result = func(*args)
+    return result, buffer.getvalue()
+
+
+def check_seed(seed, tmp_dir, alipay_rows=120, wechat_rows=40):
+    """用一个随机种子生成账单，对比读取、合并、验证和导出的结果"""
+    rng = random.Random(seed)
+    case_dir = os.path.join(tmp_dir, f'seed{seed}')
+    os.makedirs(case_dir)
+    alipay_file = os.path.join(case_dir, '支付宝.csv')
+    wechat_file = os.path.join(case_dir, '微信.xlsx')
+    write_alipay_file(alipay_file, generate_alipay_text(rng, alipay_rows))
+    write_wechat_file(wechat_file, generate_wechat_frame(rng, wechat_rows))
+
+    failures = []
+    alipay_df, _ = captured(merge_bills.read_alipay_bill, alipay_file, [])
+    wechat_df, _ = captured(merge_bills.read_wechat_bill, wechat_file, [])
+    expected_alipay = reference_read_alipay(alipay_file)
+    expected_wechat = reference_read_wechat(wechat_file)
+
+    for name, actual, expected in (('read_alipay_bill', alipay_df, expected_alipay),
+                                   ('read_wechat_bill', wechat_df, expected_wechat)):
+        if actual is None:
+            failures.append(f"{name}: 读取失败")
+            continue
+        failures.extend(f"{name}: {diff}" for diff in frame_differences(actual, expected, COMPARE_COLUMNS))
+    if failures:
+        return failures
+
+    # 交易对方规范化：与两两比较的参考实现对比规范名称，原始名称保留在"原始交易对方"列
+    normalized = (wechat_df.copy(), alipay_df.copy())
+    with configured('counterparty', enabled=True):
+        captured(merge_bills.normalize_counterparties, merge_bills.create_counterparty_index(), *normalized)
+    expected_names = reference_normalize_counterparties(*(df['交易对方'].tolist() for df in (wechat_df, alipay_df)))
+    for df, original, names in zip(normalized, (wechat_df, alipay_df), expected_names):
+        expected = pd.DataFrame({'交易对方': names, '原始交易对方': original['交易对方'].tolist()})
+        failures.extend(f"normalize_counterparties: {diff}" for diff in
+                        frame_differences(df, expected, ['交易对方', '原始交易对方']))
+
+    merged, _ = captured(merge_bills.merge_bills, wechat_df.copy(), alipay_df.copy())
+    expected_merged = reference_merge(expected_wechat, expected_alipay)
+    sort_keys = ['交易时间', '来源', '交易单号']
+    failures.extend(f"merge_bills: {diff}" for diff in
+                    frame_differences(merged, expected_merged, COMPARE_COLUMNS + ['月份'], sort_by=sort_keys))
+
+    records, amount, income_expense = reference_totals(pd.concat([expected_wechat, expected_alipay]))
+    if len(merged) != records:
+        failures.append(f"merge_bills: 记录数{len(merged)}与参考值{records}不同")
+    if abs(merged['金额'].sum() - amount) >= 0.01:
+        failures.append(f"merge_bills: 金额总和{merged['金额'].sum():.2f}与参考值{amount:.2f}不同")
+    if abs(merged['收支金额'].sum() - income_expense) >= 0.01:
+        failures.append(f"merge_bills: 收支金额总和{merged['收支金额'].sum():.2f}与参考值{income_expense:.2f}不同")
+
+    # 一致的数据与人为改动金额后的数据，验证的输出和结果都应与参考实现相同
+    tampered = merged.copy()
+    tampered.loc[0, '金额'] = tampered.loc[0, '金额'] + 1
+    # 金额缺失（NaN）时，逐行累加的预期收支金额为NaN，收支金额检查不通过
+    nan_wechat = wechat_df.copy()
+    nan_alipay = alipay_df.copy()
+    nan_wechat.loc[nan_wechat.index[::7], '金额'] = float('nan')
+    nan_alipay.loc[nan_alipay.index[::5], '金额'] = float('nan')
+    nan_merged, _ = captured(merge_bills.merge_bills, nan_wechat.copy(), nan_alipay.copy())
+    for label, inputs in (('一致数据', (wechat_df, alipay_df, merged)),
+                          ('金额被改动', (wechat_df, alipay_df, tampered)),
+                          ('金额缺失', (nan_wechat, nan_alipay, nan_merged))):
+        actual = captured(merge_bills.validate_merge_integrity, *inputs)
+        expected = captured(reference_validate, *inputs)
+        if actual != expected:
+            failures.append(f"validate_merge_integrity（{label}）: 结果或输出与参考实现不同")
+    if not captured(merge_bills.validate_merge_integrity, wechat_df, alipay_df, merged)[0]:
+        failures.append("validate_merge_integrity: 一致的数据验证未通过")
+
+    # 导出：当前实现与最初版本的导出方式逐个单元格对比
+    actual_dir = os.path.join(case_dir, 'export')
+    expected_dir = os.path.join(case_dir, 'reference_export')
+    os.makedirs(actual_dir)
+    os.makedirs(expected_dir)
+    captured(merge_bills.save_single_file, merged, actual_dir)
+    captured(merge_bills.save_by_month, merged, actual_dir)
+    reference_save(merged, expected_dir)
+    actual_files = sorted(os.listdir(actual_dir))
+    if actual_files != sorted(os.listdir(expected_dir)):
+        failures.append(f"write_bill_workbook: 导出文件不同: {actual_files}")
+    else:
+        for name in actual_files:
+            failures.extend(f"write_bill_workbook: {diff}" for diff in
+                            workbook_differences(os.path.join(actual_dir, name), os.path.join(expected_dir, name)))
+    return failures
+
+
+def check_pipeline_seed(seed, tmp_dir, months=3, rows=30):
+    """用一个随机种子生成多个月份的账单文件（含少量不属于文件所标月份的记录），
+    开启交易对方规范化，对比流水线执行与顺序执行的合并数据和各月导出文件"""
+    rng = random.Random(seed)
+    case_dir = os.path.join(tmp_dir, f'pipeline{seed}')
+    os.makedirs(case_dir)
+    start = datetime(2024, 1, 1)
+    for i in range(months):
+        month_start = datetime(start.year + (start.month - 1 + i) // 12, (start.month - 1 + i) % 12 + 1, 1)
+        period = f'{month_start:%Y%m}'
+        write_wechat_file(os.path.join(case_dir, f'微信支付账单({period}01-{period}28).xlsx'),
+                          generate_wechat_frame(rng, rows, month_start, 28, stray_days=20))
+        write_alipay_file(os.path.join(case_dir, f'支付宝交易明细({period}01-{period}28).csv'),
+                          generate_alipay_text(rng, rows, month_start, 28, stray_days=20))
+    wechat_files, alipay_files = merge_bills.find_bill_files(case_dir)
+
+    failures = []
+    sequential_dir = os.path.join(case_dir, 'sequential')
+    pipeline_dir = os.path.join(case_dir, 'pipeline')
+    with configured('counterparty', enabled=True), contextlib.redirect_stdout(io.StringIO()):
+        wechat_df = pd.concat([merge_bills.read_wechat_bill(f) for f in wechat_files], ignore_index=True)
+        alipay_df = pd.concat([merge_bills.read_alipay_bill(f) for f in alipay_files], ignore_index=True)
+        merge_bills.normalize_counterparties(merge_bills.create_counterparty_index(), wechat_df, alipay_df)
+        sequential = merge_bills.merge_bills(wechat_df, alipay_df)
+        merge_bills.save_by_month(sequential, sequential_dir)
+        _, _, pipelined, _ = merge_bills.run_pipeline(wechat_files, alipay_files, pipeline_dir)
+
+    sort_keys = ['交易时间', '来源', '交易单号']
+    failures.extend(f"run_pipeline: {diff}" for diff in
+                    frame_differences(pipelined, sequential, COMPARE_COLUMNS + ['原始交易对方', '月份'],
+                                      sort_by=sort_keys))
+    pipeline_files = sorted(os.listdir(pipeline_dir))
+    if pipeline_files != sorted(os.listdir(sequential_dir)):
+        failures.append(f"run_pipeline: 导出文件不同: {pipeline_files}")
+    else:
+        # 交易时间相同的记录在两种方式下的先后顺序可能不同
+        for name in pipeline_files:
+            failures.extend(f"run_pipeline: {diff}" for diff in
+                            workbook_differences(os.path.join(pipeline_dir, name), os.path.join(sequential_dir, name),
+                                                 ignore_row_order=True))
+    return failures
+
+
+def reconcile_case(rows):
+    """用给定记录构造合并账单并对账，返回对账标记列表"""
+    df = reconcile_frame(rows)
+    with contextlib.redirect_stdout(io.StringIO()):
+        merge_bills.reconcile_transactions(df)
+    return df['对账标记'].tolist()
+
+
+def check_reconcile_cases():
+    """固定场景的对账检查，返回失败描述列表"""
+    failures = []
+    # 微信中已退款的消费记录交易状态为"已全额退款"，仍应与对应的退款记录配对
+    tags = reconcile_case([
+        ['2024-01-05 12:00:00', '商户消费', '美团', '外卖订单', '支出', 35.5, '已全额退款', '微信'],
+        ['2024-01-06 09:00:00', '美团-退款', '美团', '外卖订单', '收入', 35.5, '已退款', '微信'],
+    ])
+    if not (tags[0].startswith('退款#') and tags[0] == tags[1]):
+        failures.append(f"reconcile_transactions: 已全额退款的消费与退款记录未配对: {tags}")
+    # 退款早于消费、金额不同或来源不同时不配对
+    tags = reconcile_case([
+        ['2024-01-06 09:00:00', '美团-退款', '美团', '外卖订单', '收入', 35.5, '已退款', '微信'],
+        ['2024-01-07 12:00:00', '商户消费', '美团', '外卖订单', '支出', 35.5, '支付成功', '微信'],
+        ['2024-01-08 12:00:00', '商户消费', '美团', '外卖订单', '支出', 20.0, '支付成功', '微信'],
+        ['2024-01-09 12:00:00', '退款', '美团', '外卖订单', '收入', 20.0, '退款成功', '支付宝'],
+    ])
+    if any(tags):
+        failures.append(f"reconcile_transactions: 不应配对的记录被标记: {tags}")
+    return failures
+
+
+def check_reconcile_seed(seed, rows=300):
+    """用一个随机种子生成对账数据（随机选择时间窗口），与逐对比较的参考实现对比配对结果"""
+    rng = random.Random(seed)
+    df = generate_reconcile_frame(rng, rows)
+    with configured('reconcile', transfer_window_hours=rng.choice([1, 24]), refund_window_days=rng.choice([1, 90])):
+        expected = reference_reconcile(df)
+        captured(merge_bills.reconcile_transactions, df)
+    actual = tag_pairs(df['对账标记'])
+    if actual != expected:
+        return [f"reconcile_transactions: 配对不同: 多出{sorted(actual - expected)[:3]}，缺少{sorted(expected - actual)[:3]}"]
+    return []
+
+
+def check_equivalence(seeds):
+    """对多个随机种子执行等价性检查"""
+    failed = 0
+    for failure in check_reconcile_cases():
+        failed += 1
+        print(f"✗ {failure}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for seed in range(seeds):
+            failures = check_seed(seed, tmp_dir) + check_pipeline_seed(seed, tmp_dir) + check_reconcile_seed(seed)
+            if failures:
+                failed += 1
+                print(f"✗ 种子{seed}:")
+                for failure in failures:
+                    print(f"    {failure}")
+    print("有意的行为差异:")
+    for description in INTENDED_DIFFERENCES.values():
+        print(f"  - {description}")
+    if failed:
+        print(f"✗ 等价性检查: {failed}/{seeds}个随机用例失败")
+    else:
+        print(f"✓ 等价性检查: {seeds}个随机用例全部一致")
+    return failed == 0
+
+
+# ---------------------------------------------------------------------------
+# 性能
+# ---------------------------------------------------------------------------
+
+def timed(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - started
+
+
+def check_performance(budget_scale=1.0):
+    """在固定规模的输入上检查各阶段耗时"""
+    rng = random.Random(0)
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        alipay_file = os.path.join(tmp_dir, '支付宝.csv')
+        wechat_file = os.path.join(tmp_dir, '微信.xlsx')
+        write_alipay_file(alipay_file, generate_alipay_text(rng, PERF_CASES['read_alipay_bill']['rows']))
+        write_wechat_file(wechat_file, generate_wechat_frame(rng, PERF_CASES['read_wechat_bill']['rows']))
+
+        alipay_df, timings['read_alipay_bill'] = timed(merge_bills.read_alipay_bill, alipay_file, [])
+        wechat_df, timings['read_wechat_bill'] = timed(merge_bills.read_wechat_bill, wechat_file, [])
+
+        # 合并、验证与导出使用放大到固定规模的数据
+        rows = PERF_CASES['merge_bills']['rows']
+        repeat = rows // (len(alipay_df) + len(wechat_df)) + 1
+        big_alipay = pd.concat([alipay_df] * repeat, ignore_index=True)
+        big_wechat = pd.concat([wechat_df] * repeat, ignore_index=True)
+        big_alipay = big_alipay.iloc[:rows - rows // 2]
+        big_wechat = big_wechat.iloc[:rows // 2]
+        merged, timings['merge_bills'] = timed(merge_bills.merge_bills, big_wechat.copy(), big_alipay.copy())
+        _, timings['validate_merge_integrity'] = timed(merge_bills.validate_merge_integrity,
+                                                       big_wechat, big_alipay, merged)
+        _, timings['save_single_file'] = timed(merge_bills.save_single_file, merged, tmp_dir)
+
+        # 规范化使用大量不同写法的交易对方：商户名称加上门店、公司后缀等变化
+        rows = PERF_CASES['normalize_counterparties']['rows']
+        merchants = random_merchant_names(rng, rows // 10)
+        variants = ['', '(北京)', '（上海店）', '有限公司', ' ']
+        names = [rng.choice(merchants) + rng.choice(variants) for _ in range(rows)]
+        frames = (pd.DataFrame({'交易对方': names[:rows // 2]}), pd.DataFrame({'交易对方': names[rows // 2:]}))
+        with configured('counterparty', enabled=True):
+            _, timings['normalize_counterparties'] = timed(merge_bills.normalize_counterparties,
+                                                           merge_bills.create_counterparty_index(), *frames)
+
+        reconcile_df = generate_reconcile_frame(rng, PERF_CASES['reconcile_transactions']['rows'], days=365)
+        _, timings['reconcile_transactions'] = timed(merge_bills.reconcile_transactions, reconcile_df)
+
+    ok = True
+    for name, case in PERF_CASES.items():
+        budget = case['budget'] * budget_scale
+        passed = timings[name] <= budget
+        ok = ok and passed
+        print(f"{'✓' if passed else '✗'} {name}（{case['rows']}条）: {timings[name]:.2f}秒，预算{budget:.2f}秒")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='账单处理流程的等价性与性能回归检查')
+    parser.add_argument('--seeds', type=int, default=20, help='随机用例数量')
+    parser.add_argument('--skip-perf', action='store_true', help='跳过性能检查')
+    parser.add_argument('--budget-scale', type=float, default=1.0, help='耗时预算的放大倍数')
+    args = parser.parse_args()
+
+    ok = check_equivalence(args.seeds)
+    if not args.skip_perf:
+        ok = check_performance(args.budget_scale) and ok
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
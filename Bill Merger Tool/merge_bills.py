@@ -1,14 +1,95 @@
 import os
-import pandas as pd
-from datetime import datetime
 import re
+import sys
+import csv
+import json
+import time
+import numbers
+import queue
+import unicodedata
+import importlib
+import threading
+import traceback
+from datetime import datetime
+from collections import Counter, defaultdict, deque
+
+
+class _LazyModule:
+    """模块代理：首次访问属性时才真正导入，避免启动阶段加载重量级依赖"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+# pandas、numpy、xlsxwriter在首次使用时才导入；openpyxl仅由读取微信账单的read_excel按需加载
+pd = _LazyModule('pandas')
+np = _LazyModule('numpy')
+xlsxwriter = _LazyModule('xlsxwriter')
+
+
+def preload_modules(need_excel_reader):
+    """在后台线程中预先导入重量级依赖，与等待用户输入的时间重叠"""
+    names = ['pandas', 'xlsxwriter']
+    if need_excel_reader:
+        names.append('openpyxl')
+
+    def _worker():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                # 缺失的依赖在真正使用时再报错
+                pass
+
+    thread = threading.Thread(target=_worker, name='preload-modules', daemon=True)
+    thread.start()
+    return thread
 
 # 配置信息
 CONFIG = {
     'wechat_columns': ['交易时间', '交易类型', '交易对方', '商品', '收/支', '金额', '支付方式', '当前状态', '交易单号', '商户单号', '备注'],
     'alipay_columns': ['交易时间', '交易类型', '交易对方', '对方账户', '商品名称', '收/支', '金额', '支付方式', '交易状态', '交易订单号', '商家订单号', '备注'],
     'merged_columns': ['交易时间', '交易类型', '交易对方', '商品/商品名称', '收/支', '金额', '收支金额', '支付方式', '交易状态'],
-    'hidden_columns': ['交易单号', '商户单号/商家订单号', '备注']
+    'hidden_columns': ['交易单号', '商户单号/商家订单号', '备注'],
+    # 交易对方规范化：同一商户的不同写法统一为一个名称，原始名称保留在导出的"原始交易对方"列
+    'counterparty': {
+        'enabled': False,
+        'ngram_size': 2,              # 模糊匹配使用的n-gram长度
+        'similarity_threshold': 0.8,  # n-gram集合的Dice相似度达到该值视为同一商户
+        'max_posting': 200,           # 出现在过多名称中的n-gram区分度低，匹配时忽略
+        'strip_suffixes': ['股份有限公司', '有限责任公司', '有限公司', '公司'],
+        'cache_file': None            # 规范化结果的持久化缓存文件（JSON），为None时不落盘
+    },
+    # 问题记录隔离表：无法解析或被丢弃的记录汇总写入一个文件，format可选csv或parquet（需要pyarrow）
+    'quarantine': {
+        'file_name': '问题记录',
+        'format': 'csv'
+    },
+    # 转账与退款对账：成对标记微信/支付宝互转记录和退款记录，导出时增加"对账标记"列
+    'reconcile': {
+        'enabled': False,
+        'exclude_from_totals': False,   # 已配对记录是否从导出的收支合计中排除
+        'transfer_window_hours': 24,    # 转出与转入记录的最大时间差
+        'refund_window_days': 90,       # 退款与原消费记录的最大时间差
+        'transfer_keywords': ['转账', '提现', '充值', '转入', '转出'],
+        'refund_keywords': ['退款']
+    },
+    # 流水线执行：读取与导出并发进行，某月数据确定后立即写出该月账单
+    'pipeline': {
+        'enabled': False,
+        'read_workers': 2,    # 并发读取账单文件的线程数
+        'export_workers': 2,  # 并发写出Excel的线程数
+        'queue_size': 4       # 各阶段之间队列的容量上限
+    }
 }
 
 # 对应关系映射
@@ -60,8 +141,77 @@ def find_bill_files(directory):
     
     return wechat_files, alipay_files
 
-def read_wechat_bill(file_path):
-    """读取微信账单并处理数据"""
+def standardize_status(series):
+    """交易状态标准化：每个不同的状态只计算一次，再映射回所有记录"""
+    def standardize(status):
+        status = str(status).strip()
+        if status == '退款':
+            return '退款'
+        for standard, variations in STATUS_MAPPING.items():
+            if status in variations:
+                return standard
+        return status
+    
+    codes, uniques = pd.factorize(series)
+    # 末尾追加缺失值的结果，使codes中的-1直接对应到它
+    resolved = np.array([standardize(value) for value in uniques] + [standardize(np.nan)], dtype=object)
+    return pd.Series(resolved[codes], index=series.index, dtype=object)
+
+def parse_datetimes(values):
+    """向量化解析交易时间，无法解析的值为NaT，结果与逐个调用pd.to_datetime一致"""
+    if int(pd.__version__.split('.')[0]) < 2:
+        return pd.to_datetime(values, errors='coerce')
+    
+    # 先按ISO8601批量解析，只有少数格式不同的值再逐个推断格式
+    parsed = pd.to_datetime(values, errors='coerce', format='ISO8601')
+    retry = parsed.isna() & values.notna() & (values != '')
+    if retry.any():
+        parsed[retry] = pd.to_datetime(values[retry], errors='coerce', format='mixed')
+    return parsed
+
+def add_quarantine(quarantine, file_path, line_numbers, reason, raw_text):
+    """将一批问题记录加入隔离表；quarantine为None时忽略"""
+    if quarantine is None or len(line_numbers) == 0:
+        return
+    quarantine.append(pd.DataFrame({
+        '文件': os.path.basename(file_path),
+        '行号': pd.array(line_numbers, dtype='Int64'),
+        '原因': reason,
+        '原始内容': raw_text
+    }))
+
+def write_quarantine(quarantine, output_dir):
+    """将隔离表一次性写入文件，控制台只输出按文件和原因汇总的数量"""
+    if not quarantine:
+        return None
+    
+    table = pd.concat(quarantine, ignore_index=True)
+    settings = CONFIG['quarantine']
+    output_file = os.path.join(output_dir, settings['file_name'])
+    
+    try:
+        if settings['format'] == 'parquet':
+            try:
+                table.to_parquet(output_file + '.parquet', index=False)
+                output_file += '.parquet'
+            except ImportError:
+                print("未安装pyarrow，隔离记录改为保存为CSV")
+                table.to_csv(output_file + '.csv', index=False, encoding='utf-8-sig')
+                output_file += '.csv'
+        else:
+            table.to_csv(output_file + '.csv', index=False, encoding='utf-8-sig')
+            output_file += '.csv'
+    except OSError as e:
+        print(f"保存隔离记录出错 {output_file}: {e}")
+        return None
+    
+    print(f"\n=== 问题记录汇总（共{len(table)}条，详见 {os.path.basename(output_file)}）===")
+    for (file, reason), count in table.groupby(['文件', '原因'], sort=False).size().items():
+        print(f"  {file} - {reason}: {count}条")
+    return output_file
+
+def read_wechat_bill(file_path, quarantine=None):
+    """读取微信账单并处理数据，问题记录加入quarantine隔离表"""
     print(f"读取微信账单: {os.path.basename(file_path)}")
     
     try:
@@ -79,21 +229,32 @@ def read_wechat_bill(file_path):
         else:
             print(f"警告：微信账单列数不足，期望{len(CONFIG['wechat_columns'])}列，实际{len(df.columns)}列")
         
+        # Excel中的行号：前16行说明 + 1行表头
+        line_numbers = df.index.to_numpy() + 18
+        
         # 数据验证
         print("\n微信账单数据验证:")
         
         # 验证交易时间
         try:
-            df['交易时间'] = pd.to_datetime(df['交易时间'], errors='coerce')
+            raw_time = df['交易时间']
+            df['交易时间'] = pd.to_datetime(raw_time, errors='coerce')
             valid_dates = df['交易时间'].count()
             print(f"交易时间有效记录: {valid_dates}/{len(df)}")
-        except:
+            bad_time = (df['交易时间'].isna() & raw_time.notna()).to_numpy()
+            add_quarantine(quarantine, file_path, line_numbers[bad_time], '交易时间无法解析',
+                           raw_time[bad_time].astype(str).to_numpy())
+        except (KeyError, TypeError, ValueError):
             print("交易时间验证失败")
         
         # 处理金额字段
         print(f"原始金额列前5个值: {df['金额'].head().tolist()}")
-        df['金额'] = df['金额'].astype(str).str.replace(r'[^\d.-]', '', regex=True)
-        df['金额'] = pd.to_numeric(df['金额'], errors='coerce').fillna(0.0)
+        raw_amount = df['金额']
+        df['金额'] = pd.to_numeric(raw_amount.astype(str).str.replace(r'[^\d.-]', '', regex=True), errors='coerce')
+        bad_amount = (df['金额'].isna() & raw_amount.notna()).to_numpy()
+        add_quarantine(quarantine, file_path, line_numbers[bad_amount], '金额无法解析(按0计入)',
+                       raw_amount[bad_amount].astype(str).to_numpy())
+        df['金额'] = df['金额'].fillna(0.0)
         
         # 金额统计
         valid_amounts = (df['金额'] != 0).sum()
@@ -104,16 +265,7 @@ def read_wechat_bill(file_path):
         
         # 交易状态标准化
         if '当前状态' in df.columns:
-            def standardize_status(status):
-                status = str(status).strip()
-                if status == '退款':
-                    return '退款'
-                for standard, variations in STATUS_MAPPING.items():
-                    if status in variations:
-                        return standard
-                return status
-            
-            df['当前状态'] = df['当前状态'].apply(standardize_status)
+            df['当前状态'] = standardize_status(df['当前状态'])
         
         # 映射到合并后的列名
         mapped_df = pd.DataFrame(columns=CONFIG['merged_columns'] + CONFIG['hidden_columns'])
@@ -129,14 +281,11 @@ def read_wechat_bill(file_path):
         return mapped_df
     except Exception as e:
         print(f"读取微信账单出错: {e}")
-        import traceback
-        traceback.print_exc()
+        add_quarantine(quarantine, file_path, [None], f'文件读取失败: {e}', [''])
         return None
-    
-    return mapped_df
 
-def read_alipay_bill(file_path):
-    """读取支付宝账单并处理数据"""
+def read_alipay_bill(file_path, quarantine=None):
+    """读取支付宝账单并处理数据，问题记录加入quarantine隔离表"""
     print(f"读取支付宝账单: {os.path.basename(file_path)}")
     
     # 手动解析支付宝账单
@@ -158,97 +307,84 @@ def read_alipay_bill(file_path):
         
         if header_index == -1:
             print("未找到支付宝账单表头")
+            add_quarantine(quarantine, file_path, [None], '未找到账单表头', [''])
             return None
         
-        # 使用csv模块正确解析
-        import csv
-        from io import StringIO
+        # 提取数据行：表头之后、结尾分隔线之前的非空行
+        data_lines = []
+        data_line_numbers = []
+        for i in range(header_index + 1, len(lines)):
+            line = lines[i].strip()
+            if line.startswith('----') or line.startswith('"----'):
+                break
+            if line:
+                data_lines.append(line)
+                data_line_numbers.append(i + 1)
         
-        # 提取数据行
+        # 每行单独用csv模块解析：不成对的引号只影响所在的行，不会把后续行并入同一条记录
         data_rows = []
-        valid_count = 0
-        error_count = 0
+        parsed_lines = []
+        parsed_line_numbers = []
+        unparsable = []
+        for line, line_number in zip(data_lines, data_line_numbers):
+            try:
+                row = next(csv.reader((line,)))
+            except csv.Error:
+                unparsable.append((line, line_number))
+                continue
+            data_rows.append(row)
+            parsed_lines.append(line)
+            parsed_line_numbers.append(line_number)
+        add_quarantine(quarantine, file_path, [n for _, n in unparsable], '无法解析的行', [l for l, _ in unparsable])
         
-        for i in range(header_index + 1, len(lines)):
-            line = lines[i].strip()
-            if line and not line.startswith('----') and not line.startswith('"----'):
-                try:
-                    # 使用csv模块正确解析行
-                    reader = csv.reader(StringIO(line))
-                    row = next(reader)
-                    data_rows.append(row)
-                    valid_count += 1
-                except Exception as parse_error:
-                    print(f"解析行{i+1}时出错: {parse_error}")
-                    print(f"行内容: {line}")
-                    error_count += 1
-        
-        print(f"解析结果: 有效行{valid_count}，错误行{error_count}")
+        print(f"解析结果: 有效行{len(data_rows)}，错误行{len(unparsable)}")
         
         if data_rows:
             print(f"第一行数据(前6列): {data_rows[0][:6]}")
             if len(data_rows) > 1:
                 print(f"第二行数据(前6列): {data_rows[1][:6]}")
         
-        # 创建映射后的DataFrame
-        mapped_df = pd.DataFrame(columns=CONFIG['merged_columns'] + CONFIG['hidden_columns'])
-        mapped_df['来源'] = '支付宝'
-        mapped_df['支付方式'] = '支付宝'  # 确保支付方式正确
-        
-        # 提取需要的字段
-        processed_count = 0
-        zero_amount_count = 0
-        
-        for row in data_rows:
-            if len(row) >= 12:
-                try:
-                    # 处理交易时间
-                    trade_time = pd.to_datetime(row[0].strip(), errors='coerce')
-                    
-                    # 处理金额
-                    amount_str = row[6].strip()
-                    amount_str = amount_str.replace('¥', '').replace(',', '')
-                    amount = pd.to_numeric(amount_str, errors='coerce')
-                    
-                    if pd.isna(amount) or amount == 0:
-                        zero_amount_count += 1
-                    
-                    # 添加记录
-                    new_row = {
-                        '交易时间': trade_time,
-                        '交易类型': row[1].strip(),
-                        '交易对方': row[2].strip(),
-                        '商品/商品名称': row[4].strip() if len(row) > 4 else '',
-                        '收/支': row[5].strip() if len(row) > 5 else '',
-                        '金额': amount if not pd.isna(amount) else 0.0,
-                        '支付方式': '支付宝',
-                        '交易状态': row[8].strip() if len(row) > 8 else '',
-                        '交易单号': row[9].strip() if len(row) > 9 else '',
-                        '商户单号/商家订单号': row[10].strip() if len(row) > 10 else '',
-                        '备注': row[11].strip() if len(row) > 11 else '',
-                        '来源': '支付宝'
-                    }
-                    
-                    # 添加到DataFrame
-                    mapped_df = pd.concat([mapped_df, pd.DataFrame([new_row])], ignore_index=True)
-                    processed_count += 1
-                    
-                except Exception as row_error:
-                    print(f"处理记录时出错: {row_error}")
-                    print(f"问题记录: {row[:6]}")
+        # 列数不足的记录
+        complete = [len(row) >= 12 for row in data_rows]
+        short = [i for i, ok in enumerate(complete) if not ok]
+        add_quarantine(quarantine, file_path, [parsed_line_numbers[i] for i in short], '列数不足',
+                       [parsed_lines[i] for i in short])
         
-        # 交易状态标准化
-        if '交易状态' in mapped_df.columns:
-            def standardize_status(status):
-                status = str(status).strip()
-                if status == '退款':
-                    return '退款'
-                for standard, variations in STATUS_MAPPING.items():
-                    if status in variations:
-                        return standard
-                return status
-            
-            mapped_df['交易状态'] = mapped_df['交易状态'].apply(standardize_status)
+        rows = [row[:12] for row, ok in zip(data_rows, complete) if ok]
+        line_numbers = np.array([n for n, ok in zip(parsed_line_numbers, complete) if ok], dtype='int64')
+        raw_lines = np.array([line for line, ok in zip(parsed_lines, complete) if ok], dtype=object)
+        table = pd.DataFrame(rows, columns=range(12), dtype=object)
+        fields = {col: table[col].str.strip() for col in (0, 1, 2, 4, 5, 6, 8, 9, 10, 11)}
+        
+        # 处理交易时间
+        trade_time = parse_datetimes(fields[0])
+        bad_time = (trade_time.isna() & (fields[0] != '')).to_numpy()
+        add_quarantine(quarantine, file_path, line_numbers[bad_time], '交易时间无法解析', raw_lines[bad_time])
+        
+        # 处理金额
+        # GBK编码的文件中人民币符号为全角的"￥"
+        amount_str = fields[6].str.replace(r'[¥￥,]', '', regex=True)
+        amount = pd.to_numeric(amount_str, errors='coerce')
+        zero_amount_count = int((amount.isna() | (amount == 0)).sum())
+        bad_amount = (amount.isna() & (fields[6] != '')).to_numpy()
+        add_quarantine(quarantine, file_path, line_numbers[bad_amount], '金额无法解析(按0计入)', raw_lines[bad_amount])
+        
+        # 创建映射后的DataFrame
+        mapped_df = pd.DataFrame({
+            '交易时间': trade_time,
+            '交易类型': fields[1],
+            '交易对方': fields[2],
+            '商品/商品名称': fields[4],
+            '收/支': fields[5],
+            '金额': amount.fillna(0.0).astype(float),
+            '支付方式': '支付宝',  # 确保支付方式正确
+            '交易状态': standardize_status(fields[8]),  # 交易状态标准化
+            '交易单号': fields[9],
+            '商户单号/商家订单号': fields[10],
+            '备注': fields[11],
+            '来源': '支付宝'
+        }, columns=CONFIG['merged_columns'] + CONFIG['hidden_columns'] + ['来源'])
+        processed_count = len(mapped_df)
         
         # 数据质量统计
         valid_dates = mapped_df['交易时间'].count()
@@ -269,8 +405,7 @@ def read_alipay_bill(file_path):
         return mapped_df
     except Exception as e:
         print(f"读取支付宝账单出错: {e}")
-        import traceback
-        traceback.print_exc()
+        add_quarantine(quarantine, file_path, [None], f'文件读取失败: {e}', [''])
         return None
 
 def extract_month(date_str):
@@ -295,35 +430,233 @@ def extract_month(date_str):
             return f"{year}-{month}"
         return None
 
-def merge_bills(wechat_df, alipay_df):
-    """合并微信和支付宝账单"""
-    print("\n=== 开始合并账单 ===")
-    
-    # 数据质量检查和清洗
-    def clean_and_validate(df, source_name):
-        if df is None or df.empty:
-            return None
-        
-        print(f"\n{source_name}账单处理:")
+# 交易对方名称中的数字（含中文数字），如"一店"与"二店"
+NUMERAL_PATTERN = re.compile(r'[\d〇零一二三四五六七八九十百千]+')
+
+class CounterpartyIndex:
+    """交易对方规范化索引
+
+    以归一化后的名称为键精确匹配，未命中时通过n-gram倒排索引查找相似度最高的已知商户；
+    每个不同的原始名称只计算一次，结果记录在memo中，可持久化到缓存文件。
+    """
+
+    def __init__(self, ngram_size=2, similarity_threshold=0.8, max_posting=200, strip_suffixes=()):
+        self.ngram_size = ngram_size
+        self.similarity_threshold = similarity_threshold
+        self.max_posting = max_posting
+        self.strip_suffixes = tuple(strip_suffixes)
+        self.memo = {}                      # 原始名称 -> 规范名称
+        self.names = []                     # 规范名称
+        self.grams = []                     # 规范名称对应的n-gram集合
+        self.digits = []                    # 规范名称中的数字序列（含中文数字），数字不同的名称不视为同一商户
+        self.by_key = {}                    # 归一化键 -> 规范名称下标
+        self.postings = defaultdict(list)   # n-gram -> 规范名称下标列表
+
+    def normalize_key(self, name):
+        """生成用于比较的归一化键：全半角统一、忽略大小写、括号内容、标点和公司后缀"""
+        key = unicodedata.normalize('NFKC', name).casefold()
+        stripped = re.sub(r'[(\[【].*?[)\]】]', '', key)
+        key = re.sub(r'[\W_]+', '', stripped) or re.sub(r'[\W_]+', '', key)
+        for suffix in self.strip_suffixes:
+            if key.endswith(suffix) and len(key) > len(suffix):
+                key = key[:-len(suffix)]
+                break
+        return key
+
+    def display_name(self, name):
+        """规范名称的显示形式：去掉括号中的门店、地区等内容"""
+        return re.sub(r'\s*[(（\[【].*?[)）\]】]\s*', '', name).strip() or name.strip()
+
+    def ngrams(self, key):
+        n = self.ngram_size
+        if len(key) <= n:
+            return {key}
+        return {key[i:i + n] for i in range(len(key) - n + 1)}
+
+    def _add(self, name, key, grams):
+        idx = len(self.names)
+        self.names.append(name)
+        self.grams.append(grams)
+        self.digits.append(NUMERAL_PATTERN.findall(key))
+        self.by_key[key] = idx
+        for gram in grams:
+            self.postings[gram].append(idx)
+        return idx
+
+    def _best_match(self, key, grams):
+        digits = NUMERAL_PATTERN.findall(key)
+        overlaps = Counter()
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting and len(posting) <= self.max_posting:
+                overlaps.update(posting)
+        best_idx, best_score = None, 0.0
+        for idx, overlap in overlaps.items():
+            if self.digits[idx] != digits:
+                continue
+            score = 2.0 * overlap / (len(grams) + len(self.grams[idx]))
+            if score > best_score:
+                best_idx, best_score = idx, score
+        if best_score >= self.similarity_threshold:
+            return best_idx
+        return None
+
+    def canonicalize(self, name):
+        """返回原始名称对应的规范名称"""
+        cached = self.memo.get(name)
+        if cached is not None:
+            return cached
         
-        # 确保所有必需列存在
-        required_columns = CONFIG['merged_columns'] + CONFIG['hidden_columns']
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = ''
+        key = self.normalize_key(name)
+        if not key:
+            canonical = name
+        elif key in self.by_key:
+            canonical = self.names[self.by_key[key]]
+        else:
+            grams = self.ngrams(key)
+            idx = self._best_match(key, grams)
+            if idx is None:
+                idx = self._add(self.display_name(name), key, grams)
+            else:
+                self.by_key[key] = idx
+            canonical = self.names[idx]
         
-        # 统计
-        valid_records = len(df)
-        valid_dates = df['交易时间'].count()
-        valid_amounts = (df['金额'] != 0).sum()
-        total_amount = df['金额'].sum()
+        self.memo[name] = canonical
+        return canonical
+
+    def canonicalize_series(self, series):
+        """批量规范化：先对原始名称去重，按出现次数从多到少计算，使最常见的写法成为规范名称"""
+        codes, uniques = pd.factorize(series)
+        if len(uniques) == 0:
+            return series
         
-        print(f"  有效记录数: {valid_records}")
-        print(f"  交易时间有效: {valid_dates}")
-        print(f"  金额有效(非0): {valid_amounts}")
-        print(f"  金额总和: {total_amount:.2f}")
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        resolved = np.empty(len(uniques), dtype=object)
+        for i in np.argsort(-counts, kind='stable'):
+            value = uniques[i]
+            resolved[i] = self.canonicalize(value) if isinstance(value, str) else value
         
-        return df
+        result = resolved[np.where(codes >= 0, codes, 0)]
+        result[codes < 0] = None
+        return pd.Series(result, index=series.index, dtype=object)
+
+    def load(self, path):
+        """从缓存文件恢复规范化结果"""
+        with open(path, 'r', encoding='utf-8') as f:
+            memo = json.load(f)
+        for name, canonical in memo.items():
+            key = self.normalize_key(canonical)
+            if key and key not in self.by_key:
+                self._add(canonical, key, self.ngrams(key))
+            self.memo[name] = canonical
+
+    def save(self, path):
+        """将规范化结果写入缓存文件"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.memo, f, ensure_ascii=False)
+
+def create_counterparty_index(cache_file=None):
+    """按配置创建交易对方规范化索引，cache_file存在时从中恢复之前的规范化结果
+
+    每次运行（批处理中每个账户）使用各自的索引，不同账户的商户写法互不影响。
+    """
+    settings = CONFIG['counterparty']
+    index = CounterpartyIndex(settings['ngram_size'], settings['similarity_threshold'],
+                              settings['max_posting'], settings['strip_suffixes'])
+    if cache_file and os.path.exists(cache_file):
+        try:
+            index.load(cache_file)
+        except (OSError, ValueError) as e:
+            print(f"读取交易对方缓存出错 {cache_file}: {e}")
+    return index
+
+def normalize_counterparties(index, *frames, cache_file=None):
+    """用index规范化各账单的交易对方，原始名称保存到"原始交易对方"列；在读取之后、合并之前执行
+
+    指定cache_file时，规范化结果写入该缓存文件。
+    """
+    if not CONFIG['counterparty']['enabled']:
+        return frames
+    
+    known = len(index.names)
+    for df in frames:
+        if df is None or df.empty or '交易对方' not in df.columns:
+            continue
+        df['原始交易对方'] = df['交易对方']
+        df['交易对方'] = index.canonicalize_series(df['交易对方'])
+    
+    merged_names = sum(1 for name, canonical in index.memo.items() if name != canonical)
+    print(f"\n交易对方规范化: 规范名称{len(index.names)}个（新增{len(index.names) - known}个），合并写法{merged_names}个")
+    
+    if cache_file:
+        try:
+            index.save(cache_file)
+        except OSError as e:
+            print(f"保存交易对方缓存出错 {cache_file}: {e}")
+    return frames
+
+def clean_and_validate(df, source_name):
+    """补齐合并所需的列并输出单个来源的数据统计"""
+    if df is None or df.empty:
+        return None
+    
+    print(f"\n{source_name}账单处理:")
+    
+    # 确保所有必需列存在
+    required_columns = CONFIG['merged_columns'] + CONFIG['hidden_columns']
+    for col in required_columns:
+        if col not in df.columns:
+            df[col] = ''
+    
+    # 统计
+    valid_records = len(df)
+    valid_dates = df['交易时间'].count()
+    valid_amounts = (df['金额'] != 0).sum()
+    total_amount = df['金额'].sum()
+    
+    print(f"  有效记录数: {valid_records}")
+    print(f"  交易时间有效: {valid_dates}")
+    print(f"  金额有效(非0): {valid_amounts}")
+    print(f"  金额总和: {total_amount:.2f}")
+    
+    return df
+
+def add_derived_columns(df):
+    """计算收支金额（支出为负值，收入为正值）并提取月份，按行独立计算，可在合并前逐个文件执行"""
+    df['收支金额'] = df['金额'].where(df['收/支'] != '支出', -df['金额'])
+    
+    if pd.api.types.is_datetime64_any_dtype(df['交易时间']):
+        # 与extract_month一致：无效时间对应的月份为None
+        months = df['交易时间'].dt.strftime('%Y-%m').astype(object)
+        months[df['交易时间'].isna()] = None
+        df['月份'] = months
+    else:
+        df['月份'] = df['交易时间'].apply(extract_month)
+    return df
+
+def print_merge_report(merged_df):
+    """输出合并后数据质量报告"""
+    print("\n=== 合并后数据质量报告 ===")
+    print(f"总记录数: {len(merged_df)}")
+    print(f"交易时间有效: {merged_df['交易时间'].count()}/{len(merged_df)}")
+    print(f"金额有效(非0): {(merged_df['金额'] != 0).sum()}/{len(merged_df)}")
+    print(f"金额总和: {merged_df['金额'].sum():.2f}")
+    print(f"收支金额总和: {merged_df['收支金额'].sum():.2f}")
+    print(f"微信记录: {(merged_df['来源'] == '微信').sum()}")
+    print(f"支付宝记录: {(merged_df['来源'] == '支付宝').sum()}")
+    
+    # 检查关键字段缺失
+    critical_fields = ['交易时间', '交易类型', '交易对方', '收/支']
+    print("\n关键字段缺失情况:")
+    for field in critical_fields:
+        missing_count = merged_df[field].isnull().sum() + (merged_df[field] == '').sum()
+        if missing_count > 0:
+            missing_pct = (missing_count / len(merged_df)) * 100
+            print(f"  {field}: {missing_count} ({missing_pct:.1f}%)")
+
+def merge_bills(wechat_df, alipay_df):
+    """合并微信和支付宝账单"""
+    print("\n=== 开始合并账单 ===")
     
     # 清洗两部分数据
     wechat_df = clean_and_validate(wechat_df, "微信")
@@ -349,100 +682,279 @@ def merge_bills(wechat_df, alipay_df):
     # 重置索引
     merged_df = merged_df.reset_index(drop=True)
     
-    # 计算收支金额（支出为负值，收入为正值）用于Python中的验证和统计
-    def calculate_income_expense(row):
-        if row['收/支'] == '支出':
-            return -row['金额']
-        else:
-            return row['金额']
-    
-    merged_df['收支金额'] = merged_df.apply(calculate_income_expense, axis=1)
-    
-    # 提取月份
-    merged_df['月份'] = merged_df['交易时间'].apply(extract_month)
+    # 计算收支金额并提取月份，用于Python中的验证和统计
+    merged_df = add_derived_columns(merged_df)
     
     # 最终数据质量报告
-    print("\n=== 合并后数据质量报告 ===")
-    print(f"总记录数: {len(merged_df)}")
-    print(f"交易时间有效: {merged_df['交易时间'].count()}/{len(merged_df)}")
-    print(f"金额有效(非0): {(merged_df['金额'] != 0).sum()}/{len(merged_df)}")
-    print(f"金额总和: {merged_df['金额'].sum():.2f}")
-    print(f"收支金额总和: {merged_df['收支金额'].sum():.2f}")
-    print(f"微信记录: {(merged_df['来源'] == '微信').sum()}")
-    print(f"支付宝记录: {(merged_df['来源'] == '支付宝').sum()}")
+    print_merge_report(merged_df)
     
-    # 检查关键字段缺失
-    critical_fields = ['交易时间', '交易类型', '交易对方', '收/支']
-    print("\n关键字段缺失情况:")
-    for field in critical_fields:
-        missing_count = merged_df[field].isnull().sum() + (merged_df[field] == '').sum()
-        if missing_count > 0:
-            missing_pct = (missing_count / len(merged_df)) * 100
-            print(f"  {field}: {missing_count} ({missing_pct:.1f}%)")
+    # 预先计算导出统计，导出阶段直接复用
+    attach_export_stats(merged_df)
     
     return merged_df
 
-def save_single_file(merged_df, output_dir):
-    """将所有月份的数据保存到单个Excel文件"""
-    if merged_df is None:
-        return
+def _pair_in_windows(group_ids, times, sides, window, ordered):
+    """在同一分组内按时间顺序贪心配对两侧记录，返回配对的位置列表[(侧0位置, 侧1位置)]
+
+    记录先按(分组, 时间, 侧)排序，每个分组只需顺序扫描一次，待配对记录超出时间窗口即被丢弃。
+    ordered为True时侧0必须早于侧1（如先消费后退款），匹配最近的一笔；否则两侧可任意先后，匹配最早的一笔。
+    """
+    order = np.lexsort((sides, times, group_ids))
+    pairs = []
+    pending = ([], [])
+    current_group = None
+    for pos in order.tolist():
+        group = group_ids[pos]
+        if group != current_group:
+            current_group = group
+            pending = (deque(), deque())
+        side = sides[pos]
+        t = times[pos]
+        if ordered and side == 0:
+            pending[0].append(pos)
+            continue
+        
+        candidates = pending[1 - side]
+        while candidates and times[candidates[0]] < t - window:
+            candidates.popleft()
+        if candidates:
+            other = candidates.pop() if ordered else candidates.popleft()
+            pairs.append((other, pos) if side == 1 else (pos, other))
+        elif not ordered:
+            pending[side].append(pos)
+    return pairs
+
+def reconcile_transactions(merged_df):
+    """识别微信与支付宝之间的互转记录以及退款与原消费记录，在"对账标记"列中成对标记
+
+    转账：来源不同、方向相反、金额相同且在时间窗口内的转账类记录；
+    退款：同一来源、同一交易对方、金额相同，且退款晚于消费并在退款窗口内。
+    转账、退款与消费记录按交易类型、商品和收支方向区分，不看交易状态。
+    """
+    settings = CONFIG['reconcile']
+    tags = np.full(len(merged_df), '', dtype=object)
+    if merged_df.empty:
+        merged_df['对账标记'] = tags
+        return merged_df
     
-    # 移除临时列和隐藏列
-    output_df = merged_df.drop(['月份', '来源'] + CONFIG['hidden_columns'], axis=1, errors='ignore')
+    times = pd.to_datetime(merged_df['交易时间'], errors='coerce')
+    valid_time = times.notna().to_numpy()
+    time_values = times.to_numpy(dtype='datetime64[ns]').astype('int64')
+    cents = np.round(pd.to_numeric(merged_df['金额'], errors='coerce').fillna(0).to_numpy(dtype=float) * 100).astype('int64')
+    is_expense = (merged_df['收/支'] == '支出').to_numpy()
+    source = merged_df['来源'].astype(str)
+    # 只按交易类型和商品判断记录类别：已退款的消费记录交易状态为"已全额退款"等，仍是消费记录
+    text = merged_df['交易类型'].astype(str) + ' ' + merged_df['商品/商品名称'].astype(str)
+    base = valid_time & (cents > 0)
+    pair_id = 0
     
-    # 确保列的顺序正确
-    output_columns = CONFIG['merged_columns']
-    output_df = output_df[output_columns]
+    # 跨平台转账：分组键为(转出平台, 金额)，转出记录为侧0，转入记录为侧1
+    transfer_pattern = '|'.join(re.escape(keyword) for keyword in settings['transfer_keywords'])
+    is_transfer = base & text.str.contains(transfer_pattern, regex=True).to_numpy()
+    candidates = np.flatnonzero(is_transfer)
+    if len(candidates):
+        from_wechat = (source.to_numpy()[candidates] == '微信') == is_expense[candidates]
+        group_ids = pd.MultiIndex.from_arrays([from_wechat, cents[candidates]]).factorize()[0]
+        sides = np.where(is_expense[candidates], 0, 1)
+        window = int(settings['transfer_window_hours'] * 3600 * 1e9)
+        for a, b in _pair_in_windows(group_ids, time_values[candidates], sides, window, ordered=False):
+            # 两侧必须来自不同平台
+            if source.iat[candidates[a]] == source.iat[candidates[b]]:
+                continue
+            pair_id += 1
+            tags[candidates[a]] = tags[candidates[b]] = f'跨平台转账#{pair_id}'
+    transfer_pairs = pair_id
     
-    # 生成文件名 - 合并导出时使用"总账单.xlsx"
-    filename = "总账单.xlsx"
+    # 退款冲抵：分组键为(来源, 交易对方, 金额)，消费记录为侧0，退款记录为侧1
+    refund_pattern = '|'.join(re.escape(keyword) for keyword in settings['refund_keywords'])
+    is_refund_text = text.str.contains(refund_pattern, regex=True).to_numpy()
+    untagged = tags == ''
+    is_refund = base & untagged & is_refund_text & ~is_expense
+    is_purchase = base & untagged & ~is_refund_text & is_expense
+    candidates = np.flatnonzero(is_refund | is_purchase)
+    if len(candidates):
+        counterparty = merged_df['交易对方'].astype(str).to_numpy()
+        group_ids = pd.MultiIndex.from_arrays([source.to_numpy()[candidates], counterparty[candidates],
+                                               cents[candidates]]).factorize()[0]
+        sides = np.where(is_refund[candidates], 1, 0)
+        window = int(settings['refund_window_days'] * 86400 * 1e9)
+        for a, b in _pair_in_windows(group_ids, time_values[candidates], sides, window, ordered=True):
+            pair_id += 1
+            tags[candidates[a]] = tags[candidates[b]] = f'退款#{pair_id}'
     
-    output_file = os.path.join(output_dir, filename)
+    merged_df['对账标记'] = tags
+    print("\n=== 转账与退款对账 ===")
+    print(f"跨平台转账配对: {transfer_pairs}组")
+    print(f"退款冲抵配对: {pair_id - transfer_pairs}组")
+    if settings['exclude_from_totals']:
+        excluded = merged_df['收支金额'].astype(float)[tags != ''].sum()
+        print(f"已配对记录不计入导出合计，收支金额调整: {-excluded:.2f}")
+    return merged_df
+
+def export_income_expense(df):
+    """导出合计使用的收支金额；开启exclude_from_totals时已配对的转账和退款记录按0计"""
+    values = df['收支金额'].astype(float)
+    if CONFIG['reconcile']['exclude_from_totals'] and '对账标记' in df.columns:
+        values = values.where(df['对账标记'] == '', 0.0)
+    return values
+
+# 会计专用格式（带人民币符号），负数使用负号而不是括号
+ACCOUNTING_NUM_FORMAT = '_([$¥-804]* #,##0.00_);_([$¥-804]* -#,##0.00_);_([$¥-804]* "-"??_);_(@_)'
+
+# 按月导出时的列宽
+MONTH_COLUMN_WIDTHS = {
+    '交易时间': 20,
+    '交易类型': 15,
+    '交易对方': 25,
+    '商品/商品名称': 30,
+    '收/支': 8,
+    '金额': 15,
+    '收支金额': 15,
+    '支付方式': 12,
+    '交易状态': 12,
+    '原始交易对方': 25,
+    '对账标记': 16
+}
+
+# 写出Excel时每批处理的行数
+EXPORT_BATCH_ROWS = 5000
+
+# 交易时间单元格的显示格式（与pandas.ExcelWriter写入日期时间的默认格式一致），列格式只作用于空白单元格
+DATETIME_CELL_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+
+def compute_export_stats(df):
+    """计算导出时输出的统计信息：记录数、金额总和、收支金额总和与来源分布"""
+    return {
+        'records': len(df),
+        'amount': float(df['金额'].sum()),
+        'income_expense': float(export_income_expense(df).sum()),
+        'wechat': int((df['来源'] == '微信').sum()),
+        'alipay': int((df['来源'] == '支付宝').sum())
+    }
+
+def attach_export_stats(merged_df):
+    """在合并阶段一次性计算总体及各月份的统计信息，保存在merged_df.attrs中供导出阶段复用"""
+    amounts = merged_df['金额'].astype(float)
+    income_expense = export_income_expense(merged_df)
+    grouped = pd.DataFrame({
+        '月份': merged_df['月份'],
+        'amount': amounts,
+        'income_expense': income_expense,
+        'wechat': merged_df['来源'] == '微信',
+        'alipay': merged_df['来源'] == '支付宝'
+    }).groupby('月份', sort=False)
+    sums = grouped.sum()
+    sizes = grouped.size()
     
-    # 保存为Excel文件，使用xlsxwriter进行高级格式化
+    by_month = {}
+    for month, row in sums.iterrows():
+        by_month[month] = {
+            'records': int(sizes[month]),
+            'amount': float(row['amount']),
+            'income_expense': float(row['income_expense']),
+            'wechat': int(row['wechat']),
+            'alipay': int(row['alipay'])
+        }
+    merged_df.attrs['export_stats'] = {'total': compute_export_stats(merged_df), 'by_month': by_month}
+    return merged_df
+
+def export_view(df):
+    """投影出CONFIG['merged_columns']中的显示列（规范化后追加"原始交易对方"列，对账后追加"对账标记"列），
+    直接引用底层数组，不复制数据"""
+    columns = list(CONFIG['merged_columns'])
+    if '原始交易对方' in df.columns:
+        columns.append('原始交易对方')
+    if '对账标记' in df.columns:
+        columns.append('对账标记')
+    return [(col, df[col].to_numpy()) for col in columns]
+
+def _cell_values(values):
+    """将一批底层数组数据转换为可直接写入Excel的Python对象"""
+    if values.dtype.kind == 'M':
+        # datetime64转换为datetime，NaT转换为None
+        return values.astype('datetime64[us]').astype(object)
+    if values.dtype.kind in 'iufb':
+        return values.tolist()
+    return values
+
+def iter_export_batches(view, batch_rows=EXPORT_BATCH_ROWS):
+    """按批次从导出视图中产出行数据，每批只转换当前批次的数据"""
+    num_rows = len(view[0][1]) if view else 0
+    for start in range(0, num_rows, batch_rows):
+        stop = min(start + batch_rows, num_rows)
+        yield start, zip(*[_cell_values(values[start:stop]) for _, values in view])
+
+def write_bill_workbook(output_file, sheet_name, view, date_num_format, column_widths=None):
+    """将导出视图写入带格式的Excel文件
+
+    使用xlsxwriter的constant_memory模式逐行写出，写出的行立即刷新到磁盘；
+    收支金额列写入Excel公式，并以已计算的数值作为公式缓存结果；
+    对账后开启exclude_from_totals时，已配对记录的公式结果为0，不计入SUBTOTAL合计。
+    """
+    columns = [col for col, _ in view]
+    num_rows = len(view[0][1]) if view else 0
+    num_cols = len(columns)
+    
+    workbook = xlsxwriter.Workbook(output_file, {'constant_memory': True})
     try:
-        import xlsxwriter
-        
-        # 创建Excel writer
-        writer = pd.ExcelWriter(output_file, engine='xlsxwriter')
+        worksheet = workbook.add_worksheet(sheet_name)
         
-        # 写入数据（不包含索引）
-        output_df.to_excel(writer, index=False, sheet_name='合并账单')
+        date_format = workbook.add_format({'num_format': date_num_format})
+        datetime_cell_format = workbook.add_format({'num_format': DATETIME_CELL_FORMAT})
+        accounting_format = workbook.add_format({'num_format': ACCOUNTING_NUM_FORMAT})
         
-        # 获取workbook和worksheet对象
-        workbook = writer.book
-        worksheet = writer.sheets['合并账单']
-        
-        # 设置日期格式
-        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
-        
-        # 设置会计专用格式（带人民币符号）
-        accounting_format = workbook.add_format({'num_format': '_([$¥-804]* #,##0.00_);_([$¥-804]* -#,##0.00_);_([$¥-804]* "-"??_);_(@_)'})
+        # 设置列宽
+        if column_widths:
+            for col_idx, col_name in enumerate(columns):
+                worksheet.set_column(col_idx, col_idx, column_widths.get(col_name, 15))
         
         # 应用日期格式到第一列
         worksheet.set_column(0, 0, 20, date_format)
         
         # 获取列索引
-        amount_col = output_df.columns.get_loc('金额')
-        income_expense_col = output_df.columns.get_loc('收支金额')
+        amount_col = columns.index('金额')
+        income_expense_col = columns.index('收支金额')
+        type_col = columns.index('收/支')
         income_expense_col_letter = xlsxwriter.utility.xl_col_to_name(income_expense_col)
         amount_col_letter = xlsxwriter.utility.xl_col_to_name(amount_col)
-        type_col = output_df.columns.get_loc('收/支')
         type_col_letter = xlsxwriter.utility.xl_col_to_name(type_col)
-        
-        # 获取数据行数
-        num_rows = len(output_df)
-        num_cols = len(output_df.columns)
+        tag_col = None
+        if CONFIG['reconcile']['exclude_from_totals'] and '对账标记' in columns:
+            tag_col = columns.index('对账标记')
+            tag_col_letter = xlsxwriter.utility.xl_col_to_name(tag_col)
         
         # 设置列宽和会计专用格式
         worksheet.set_column(amount_col, amount_col, 15, accounting_format)  # 金额列使用会计专用格式
         worksheet.set_column(income_expense_col, income_expense_col, 15, accounting_format)  # 收支金额列使用会计专用格式
         
-        # 为每一行的收支金额设置Excel公式：=IF(收/支="支出", -金额, 金额)
-        # 注意：这里会覆盖DataFrame中的数值，使用Excel公式
-        for row_num in range(1, num_rows + 1):  # 从第2行开始（Excel索引从1开始）
-            formula = f'=IF({type_col_letter}{row_num+1}="支出", -{amount_col_letter}{row_num+1}, {amount_col_letter}{row_num+1})'
-            worksheet.write_formula(row_num, income_expense_col, formula, accounting_format)
+        # 写入表头
+        worksheet.write_row(0, 0, columns)
+        
+        for start, rows in iter_export_batches(view):
+            for offset, values in enumerate(rows):
+                row_num = start + offset + 1  # 从第2行开始（Excel索引从1开始）
+                for col_idx, value in enumerate(values):
+                    if col_idx == income_expense_col:
+                        # 收支金额使用Excel公式：=IF(收/支="支出", -金额, 金额)
+                        formula = f'IF({type_col_letter}{row_num+1}="支出", -{amount_col_letter}{row_num+1}, {amount_col_letter}{row_num+1})'
+                        cached = value if isinstance(value, numbers.Real) and value == value else 0
+                        if tag_col is None:
+                            formula = f'={formula}'
+                        else:
+                            # 已配对记录不计入合计：=IF(对账标记<>"", 0, IF(...))
+                            formula = f'=IF({tag_col_letter}{row_num+1}<>"", 0, {formula})'
+                            if values[tag_col]:
+                                cached = 0
+                        worksheet.write_formula(row_num, col_idx, formula, accounting_format, cached)
+                    elif value is None or value != value or value == '':
+                        # 空值、NaN和NaT保持空白单元格
+                        continue
+                    elif isinstance(value, datetime):
+                        worksheet.write_datetime(row_num, col_idx, value, datetime_cell_format)
+                    elif isinstance(value, numbers.Real):
+                        worksheet.write_number(row_num, col_idx, value)
+                    else:
+                        worksheet.write_string(row_num, col_idx, str(value))
         
         # 冻结首行
         worksheet.freeze_panes(1, 0)
@@ -455,25 +967,63 @@ def save_single_file(merged_df, output_dir):
         # 第一列保持空白，不写"合计"文字
         subtotal_formula = f'=SUBTOTAL(9,{income_expense_col_letter}2:{income_expense_col_letter}{num_rows + 1})'
         worksheet.write(subtotal_row, income_expense_col, subtotal_formula, accounting_format)  # 使用会计专用格式
-        
+    finally:
         # 保存文件
-        writer.close()
+        workbook.close()
+
+def print_export_summary(stats):
+    """输出导出文件的统计信息"""
+    print(f"  记录数: {stats['records']}")
+    print(f"  金额统计: 总计{stats['amount']:.2f}元")
+    print(f"  收支金额总计: {stats['income_expense']:.2f}元")
+    print(f"  微信记录: {stats['wechat']}")
+    print(f"  支付宝记录: {stats['alipay']}")
+    print(f"  首行已冻结，筛选功能已开启")
+    print(f"  日期格式已设置，金额列已应用会计专用格式")
+    print(f"  收支金额列已添加，SUBTOTAL公式已计算")
+
+def save_single_file(merged_df, output_dir):
+    """将所有月份的数据保存到单个Excel文件，返回保存的文件路径，失败时返回None"""
+    if merged_df is None:
+        return None
+    
+    # 生成文件名 - 合并导出时使用"总账单.xlsx"
+    filename = "总账单.xlsx"
+    
+    output_file = os.path.join(output_dir, filename)
+    
+    # 保存为Excel文件，使用xlsxwriter进行高级格式化
+    try:
+        write_bill_workbook(output_file, '合并账单', export_view(merged_df), 'yyyy-mm-dd')
         
+        stats = merged_df.attrs.get('export_stats', {}).get('total') or compute_export_stats(merged_df)
         print(f"\n已保存到单个文件: {output_file}")
-        print(f"  记录数: {len(output_df)}")
-        print(f"  金额统计: 总计{output_df['金额'].sum():.2f}元")
-        print(f"  收支金额总计: {output_df['收支金额'].sum():.2f}元")
-        print(f"  微信记录: {(merged_df['来源'] == '微信').sum()}")
-        print(f"  支付宝记录: {(merged_df['来源'] == '支付宝').sum()}")
-        print(f"  首行已冻结，筛选功能已开启")
-        print(f"  日期格式已设置，金额列已应用会计专用格式")
-        print(f"  收支金额列已添加，SUBTOTAL公式已计算")
+        print_export_summary(stats)
+        return output_file
         
     except Exception as e:
         print(f"保存文件出错 {output_file}: {e}")
-        import traceback
         traceback.print_exc()
+        return None
+
 
+def month_slices(merged_df):
+    """按月份切分合并账单，返回[(月份, 数据)]
+
+    合并账单已按交易时间排序，同一月份的记录连续存放，此时直接返回行切片（视图）；
+    若同一月份出现在多个不连续的区间，则退回按条件筛选。
+    """
+    months = merged_df['月份'].to_numpy()
+    if len(months) == 0:
+        return []
+    
+    starts = np.flatnonzero(np.concatenate(([True], months[1:] != months[:-1])))
+    stops = np.append(starts[1:], len(months))
+    run_months = [months[start] for start in starts]
+    
+    if len(set(run_months)) == len(run_months):
+        return [(month, merged_df.iloc[start:stop]) for month, start, stop in zip(run_months, starts, stops)]
+    return [(month, merged_df[merged_df['月份'] == month]) for month in dict.fromkeys(run_months)]
 
 def save_by_month(merged_df, output_dir):
     """按月份保存合并后的账单"""
@@ -490,117 +1040,31 @@ def save_by_month(merged_df, output_dir):
         os.makedirs(output_dir)
     
     # 按月份分组并保存
-    months = merged_df['月份'].unique()
-    print(f"\n保存月份: {sorted([m for m in months if m is not None])}")
+    slices = [(month, month_df) for month, month_df in month_slices(merged_df) if month is not None]
+    print(f"\n保存月份: {sorted(month for month, _ in slices)}")
     
-    for month in months:
-        if month is not None:
-            month_df = merged_df[merged_df['月份'] == month]
-            
-            # 移除临时列和隐藏列
-            output_df = month_df.drop(['月份', '来源'] + CONFIG['hidden_columns'], axis=1, errors='ignore')
-            
-            # 确保列的顺序正确
-            output_columns = CONFIG['merged_columns']
-            output_df = output_df[output_columns]
-            
-            # 生成文件名
-            month_name = month_str_to_chinese(month)
-            output_file = os.path.join(output_dir, f"{month_name}账单.xlsx")
-            
-            # 保存为Excel文件，使用xlsxwriter进行高级格式化
-            try:
-                import xlsxwriter
-                
-                # 创建Excel writer
-                writer = pd.ExcelWriter(output_file, engine='xlsxwriter')
-                
-                # 写入数据（不包含索引）
-                output_df.to_excel(writer, sheet_name='账单明细', index=False)
-                
-                # 获取工作簿和工作表
-                workbook = writer.book
-                worksheet = writer.sheets['账单明细']
-                
-                # 获取数据范围
-                num_rows = len(output_df)
-                num_cols = len(output_df.columns)
-                
-                # 设置列宽
-                column_widths = {
-                    '交易时间': 20,
-                    '交易类型': 15,
-                    '交易对方': 25,
-                    '商品/商品名称': 30,
-                    '收/支': 8,
-                    '金额': 15,
-                    '收支金额': 15,
-                    '支付方式': 12,
-                    '交易状态': 12
-                }
-                
-                for col_idx, col_name in enumerate(output_df.columns):
-                    if col_name in column_widths:
-                        worksheet.set_column(col_idx, col_idx, column_widths[col_name])
-                    else:
-                        worksheet.set_column(col_idx, col_idx, 15)
-                
-                # 创建格式
-                date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm'})
-                # 添加会计专用格式，确保Excel识别为会计专用格式
-                # 修改会计专用格式，让负数使用负号而不是括号
-                accounting_format = workbook.add_format({'num_format': '_([$¥-804]* #,##0.00_);_([$¥-804]* -#,##0.00_);_([$¥-804]* "-"??_);_(@_)'})
-                
-                # 应用日期格式到第一列
-                worksheet.set_column(0, 0, 20, date_format)
-                
-                # 获取列索引
-                amount_col = output_df.columns.get_loc('金额')
-                income_expense_col = output_df.columns.get_loc('收支金额')
-                income_expense_col_letter = xlsxwriter.utility.xl_col_to_name(income_expense_col)
-                amount_col_letter = xlsxwriter.utility.xl_col_to_name(amount_col)
-                type_col = output_df.columns.get_loc('收/支')
-                type_col_letter = xlsxwriter.utility.xl_col_to_name(type_col)
-                
-                # 设置列宽和会计专用格式
-                worksheet.set_column(amount_col, amount_col, 15, accounting_format)  # 金额列使用会计专用格式
-                worksheet.set_column(income_expense_col, income_expense_col, 15, accounting_format)  # 收支金额列使用会计专用格式
-                
-                # 为每一行的收支金额设置Excel公式：=IF(收/支="支出", -金额, 金额)
-                # 注意：这里会覆盖DataFrame中的数值，使用Excel公式
-                for row_num in range(1, num_rows + 1):  # 从第2行开始（Excel索引从1开始）
-                    formula = f'=IF({type_col_letter}{row_num+1}="支出", -{amount_col_letter}{row_num+1}, {amount_col_letter}{row_num+1})'
-                    worksheet.write_formula(row_num, income_expense_col, formula, accounting_format)
-                
-                # 冻结首行
-                worksheet.freeze_panes(1, 0)
-                
-                # 添加筛选功能
-                worksheet.autofilter(0, 0, num_rows, num_cols - 1)
-                
-                # 添加SUBTOTAL公式计算收支金额总和
-                subtotal_row = num_rows + 1
-                # 第一列保持空白，不写"合计"文字
-                subtotal_formula = f'=SUBTOTAL(9,{income_expense_col_letter}2:{income_expense_col_letter}{num_rows + 1})'
-                worksheet.write(subtotal_row, income_expense_col, subtotal_formula, accounting_format)  # 使用会计专用格式
-                
-                # 保存文件
-                writer.close()
-                
-                print(f"\n已保存: {output_file}")
-                print(f"  记录数: {len(output_df)}")
-                print(f"  金额统计: 总计{output_df['金额'].sum():.2f}元")
-                print(f"  收支金额总计: {output_df['收支金额'].sum():.2f}元")
-                print(f"  微信记录: {(month_df['来源'] == '微信').sum()}")
-                print(f"  支付宝记录: {(month_df['来源'] == '支付宝').sum()}")
-                print(f"  首行已冻结，筛选功能已开启")
-                print(f"  日期格式已设置，金额列已应用会计专用格式")
-                print(f"  收支金额列已添加，SUBTOTAL公式已计算")
-                
-            except Exception as e:
-                print(f"保存文件出错 {output_file}: {e}")
-                import traceback
-                traceback.print_exc()
+    stats_by_month = merged_df.attrs.get('export_stats', {}).get('by_month', {})
+    for month, month_df in slices:
+        save_month_file(month, month_df, output_dir, stats_by_month.get(month))
+
+def save_month_file(month, month_df, output_dir, stats=None):
+    """将单个月份的账单保存为Excel文件，返回保存的文件路径，失败时返回None"""
+    # 生成文件名
+    month_name = month_str_to_chinese(month)
+    output_file = os.path.join(output_dir, f"{month_name}账单.xlsx")
+    
+    # 保存为Excel文件，使用xlsxwriter进行高级格式化
+    try:
+        write_bill_workbook(output_file, '账单明细', export_view(month_df), 'yyyy-mm-dd hh:mm', MONTH_COLUMN_WIDTHS)
+        
+        print(f"\n已保存: {output_file}")
+        print_export_summary(stats or compute_export_stats(month_df))
+        return output_file
+        
+    except Exception as e:
+        print(f"保存文件出错 {output_file}: {e}")
+        traceback.print_exc()
+        return None
 
 def month_str_to_chinese(month_str):
     """将月份字符串转换为中文格式"""
@@ -651,14 +1115,8 @@ def validate_merge_integrity(wechat_df, alipay_df, merged_df):
         if df is None:
             return 0
         
-        # 与实际计算相同的逻辑：支出为负，其他为正
-        expected_income_expense = 0
-        for _, row in df.iterrows():
-            if row['收/支'] == '支出':
-                expected_income_expense -= row['金额']
-            else:
-                expected_income_expense += row['金额']
-        return expected_income_expense
+        # 与实际计算相同的逻辑：支出为负，其他为正；金额缺失时结果为NaN，验证不通过
+        return df['金额'].where(df['收/支'] != '支出', -df['金额']).sum(skipna=False)
     
     expected_income_expense = 0
     if wechat_df is not None:
@@ -694,6 +1152,504 @@ def validate_merge_integrity(wechat_df, alipay_df, merged_df):
     
     return expected_records == actual_records and abs(expected_amount - actual_amount) < 0.01
 
+def bill_period(file_path):
+    """推断账单覆盖的月份范围(起始月份, 终止月份)，无法推断时返回None
+
+    优先使用导出文件名中的日期区间，如「支付宝交易明细(20240101-20240331).csv」；
+    支付宝CSV再尝试读取表头中的起始/终止时间。
+    """
+    match = re.search(r'(\d{4})(\d{2})\d{2}\D{1,3}(\d{4})(\d{2})\d{2}', os.path.basename(file_path))
+    if match:
+        return f"{match.group(1)}-{match.group(2)}", f"{match.group(3)}-{match.group(4)}"
+    
+    if file_path.endswith('.csv'):
+        try:
+            with open(file_path, 'r', encoding='gbk') as f:
+                head = ''.join(line for _, line in zip(range(40), f))
+        except (OSError, UnicodeDecodeError):
+            return None
+        start = re.search(r'起始时间[：:]\s*\[?(\d{4})-(\d{2})', head)
+        end = re.search(r'终止时间[：:]\s*\[?(\d{4})-(\d{2})', head)
+        if start and end:
+            return f"{start.group(1)}-{start.group(2)}", f"{end.group(1)}-{end.group(2)}"
+    return None
+
+def run_pipeline(wechat_files, alipay_files, output_dir, by_month=True, quarantine=None):
+    """流水线方式处理账单：读取、标准化、合并、导出四个阶段通过有界队列衔接
+
+    某个月份不再可能出现在尚未读取的文件中时即视为数据确定，立即交给导出线程写出，
+    与后续文件的解析重叠进行。文件名或表头中的日期区间与实际记录不符时，已导出的月份
+    可能在之后的文件中再次出现，此时合并该月全部记录重新导出；同一月份的写出串行进行，
+    过时的导出任务直接跳过。合并导出模式下只在全部读取完成后写出总账单；
+    开启交易对方规范化或转账与退款对账时，规范名称取决于全部账单、配对可能跨越月份，
+    各月账单在全部读取、规范化并对账后再写出。
+    读取阶段的问题记录加入quarantine隔离表。返回 (微信账单, 支付宝账单, 合并账单, 耗时统计)。
+    """
+    settings = CONFIG['pipeline']
+    defer_export = CONFIG['counterparty']['enabled'] or CONFIG['reconcile']['enabled']
+    started = time.perf_counter()
+    timings = {'read': 0.0, 'export': 0.0, 'first_export': None}
+    timings_lock = threading.Lock()
+    
+    files = [(file, '微信') for file in wechat_files] + [(file, '支付宝') for file in alipay_files]
+    periods = {file: bill_period(file) for file, _ in files}
+    
+    file_queue = queue.Queue()
+    raw_queue = queue.Queue(maxsize=settings['queue_size'])
+    normalized_queue = queue.Queue(maxsize=settings['queue_size'])
+    export_queue = queue.Queue(maxsize=settings['queue_size'])
+    for item in files:
+        file_queue.put(item)
+    
+    def read_stage():
+        while True:
+            try:
+                file, source = file_queue.get_nowait()
+            except queue.Empty:
+                return
+            stage_start = time.perf_counter()
+            df = None
+            try:
+                reader = read_wechat_bill if source == '微信' else read_alipay_bill
+                df = reader(file, quarantine)
+            except Exception as e:
+                print(f"读取账单出错 {os.path.basename(file)}: {e}")
+            finally:
+                with timings_lock:
+                    timings['read'] += time.perf_counter() - stage_start
+                raw_queue.put((file, source, df))
+    
+    def normalize_stage():
+        # 按读取完成的先后处理，队列之外不缓存账单
+        for _ in range(len(files)):
+            file, source, df = raw_queue.get()
+            try:
+                df = clean_and_validate(df, source)
+                if df is not None:
+                    df = add_derived_columns(df)
+            except Exception as e:
+                print(f"标准化账单出错 {os.path.basename(file)}: {e}")
+                df = None
+            normalized_queue.put((file, source, df))
+    
+    # 每个月份的最新导出版本与写出锁，保证同一文件不会被两个线程同时写出
+    export_versions = {}
+    month_locks = defaultdict(threading.Lock)
+    
+    def export_stage():
+        while True:
+            item = export_queue.get()
+            if item is None:
+                return
+            month, version, month_df, stats = item
+            stage_start = time.perf_counter()
+            if month is None:
+                save_single_file(month_df, output_dir)
+            else:
+                with timings_lock:
+                    lock = month_locks[month]
+                with lock:
+                    with timings_lock:
+                        stale = version != export_versions[month]
+                    if stale:
+                        continue
+                    save_month_file(month, month_df, output_dir, stats)
+            with timings_lock:
+                timings['export'] += time.perf_counter() - stage_start
+                if timings['first_export'] is None:
+                    timings['first_export'] = time.perf_counter() - started
+    
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    
+    workers = [threading.Thread(target=read_stage, name=f'pipeline-read-{i}', daemon=True)
+               for i in range(max(1, min(settings['read_workers'], len(files))))]
+    workers.append(threading.Thread(target=normalize_stage, name='pipeline-normalize', daemon=True))
+    exporters = [threading.Thread(target=export_stage, name=f'pipeline-export-{i}', daemon=True)
+                 for i in range(max(1, settings['export_workers']))]
+    for worker in workers + exporters:
+        worker.start()
+    
+    # 合并阶段在当前线程执行：按月份归集数据，月份确定后排序并送入导出队列
+    pending = set(file for file, _ in files)
+    partitions = {}
+    order = {file: i for i, (file, _) in enumerate(files)}
+    finalized = {}
+    source_frames = {}
+    
+    def month_is_final(month):
+        for file in pending:
+            period = periods[file]
+            if period is None or period[0] <= month <= period[1]:
+                return False
+        return True
+    
+    def pop_partition(month):
+        # 同一月份的数据按文件列表顺序拼接，交易时间相同的记录先后顺序与读取线程完成的先后无关
+        return [df for _, df in sorted(partitions.pop(month), key=lambda item: item[0])]
+    
+    def finalize(month):
+        frames = pop_partition(month)
+        if month in finalized:
+            # 已导出的月份又出现了新记录：与之前的记录合并后整月重新导出
+            print(f"{month_str_to_chinese(month)}在后续文件中出现了{sum(len(f) for f in frames)}条记录，重新导出该月账单")
+            frames = [finalized[month]] + frames
+        month_df = pd.concat(frames, ignore_index=True)
+        month_df = month_df.sort_values('交易时间', kind='mergesort').reset_index(drop=True)
+        finalized[month] = month_df
+        if by_month and not defer_export:
+            with timings_lock:
+                version = export_versions.get(month, 0) + 1
+                export_versions[month] = version
+            export_queue.put((month, version, month_df, compute_export_stats(month_df)))
+    
+    for _ in range(len(files)):
+        file, source, df = normalized_queue.get()
+        pending.discard(file)
+        if df is not None:
+            source_frames[file] = df
+            no_month = df['月份'].isna()
+            if no_month.any():
+                partitions.setdefault(None, []).append((order[file], df[no_month]))
+            for month, month_df in df[~no_month].groupby('月份', sort=False):
+                partitions.setdefault(month, []).append((order[file], month_df))
+        for month in sorted(m for m in partitions if m is not None):
+            if month_is_final(month):
+                finalize(month)
+    
+    finished = list(finalized.values())
+    # 无法确定月份的记录不单独导出，仅保留在合并结果中
+    if None in partitions:
+        finished.append(pd.concat(pop_partition(None), ignore_index=True))
+    
+    # 各来源的账单按文件列表顺序拼接，与读取线程完成的先后无关
+    def concat_source(source):
+        frames = [source_frames[file] for file, file_source in files
+                  if file_source == source and file in source_frames]
+        return pd.concat(frames, ignore_index=True) if frames else None
+    
+    wechat_df = concat_source('微信')
+    alipay_df = concat_source('支付宝')
+    
+    merged_df = None
+    if finished:
+        merged_df = pd.concat(finished, ignore_index=True)
+        merged_df = merged_df.sort_values('交易时间', kind='mergesort').reset_index(drop=True)
+        # 与顺序执行相同，全部读取后先按微信、支付宝账单规范化一次，再把同样的规范名称应用到合并账单
+        cache_file = CONFIG['counterparty']['cache_file']
+        normalize_counterparties(create_counterparty_index(cache_file), wechat_df, alipay_df, merged_df,
+                                 cache_file=cache_file)
+        print_merge_report(merged_df)
+        if CONFIG['reconcile']['enabled']:
+            reconcile_transactions(merged_df)
+        attach_export_stats(merged_df)
+        if not by_month:
+            export_queue.put((None, None, merged_df, None))
+        elif defer_export:
+            stats_by_month = merged_df.attrs['export_stats']['by_month']
+            for month, month_df in month_slices(merged_df):
+                if month is not None:
+                    with timings_lock:
+                        export_versions[month] = 1
+                    export_queue.put((month, 1, month_df, stats_by_month.get(month)))
+    
+    for _ in exporters:
+        export_queue.put(None)
+    for worker in workers + exporters:
+        worker.join()
+    
+    timings['total'] = time.perf_counter() - started
+    
+    print("\n=== 流水线耗时 ===")
+    print(f"端到端耗时: {timings['total']:.2f}秒")
+    if timings['first_export'] is not None:
+        print(f"首个账单写出耗时: {timings['first_export']:.2f}秒")
+    print(f"读取阶段累计: {timings['read']:.2f}秒，导出阶段累计: {timings['export']:.2f}秒")
+    
+    return wechat_df, alipay_df, merged_df, timings
+
+def load_batch_manifest(manifest_path):
+    """读取批处理清单（JSON），返回账户列表；相对路径以清单文件所在目录为基准
+
+    清单格式：
+    {"accounts": [{"name": "张三", "input_dir": "zhangsan", "output_dir": "out/zhangsan", "export_mode": "month"}]}
+    output_dir缺省时与input_dir相同，export_mode可选month（按月份导出，默认）或single（合并导出）。
+    各账户的输出目录必须互不相同，且不能是其他账户的输入目录，否则导出的账单和问题记录会互相覆盖。
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = manifest.get('accounts') if isinstance(manifest, dict) else manifest
+    if not entries:
+        raise ValueError("批处理清单中没有账户")
+    
+    accounts = []
+    names = set()
+    for i, entry in enumerate(entries):
+        name = str(entry.get('name') or f'账户{i + 1}')
+        if name in names:
+            raise ValueError(f"批处理清单中账户名称重复: {name}")
+        names.add(name)
+        if not entry.get('input_dir'):
+            raise ValueError(f"账户{name}缺少input_dir")
+        export_mode = entry.get('export_mode', 'month')
+        if export_mode not in ('month', 'single'):
+            raise ValueError(f"账户{name}的export_mode无效: {export_mode}")
+        input_dir = os.path.join(base_dir, entry['input_dir'])
+        output_dir = os.path.join(base_dir, entry.get('output_dir') or entry['input_dir'])
+        accounts.append({'name': name, 'input_dir': input_dir, 'output_dir': output_dir, 'export_mode': export_mode})
+    
+    def real_dir(path):
+        return os.path.normcase(os.path.realpath(path))
+    
+    output_owners = {}
+    for account in accounts:
+        owner = output_owners.setdefault(real_dir(account['output_dir']), account['name'])
+        if owner != account['name']:
+            raise ValueError(f"账户{owner}与{account['name']}的输出目录相同: {account['output_dir']}")
+    for account in accounts:
+        owner = output_owners.get(real_dir(account['input_dir']))
+        if owner is not None and owner != account['name']:
+            raise ValueError(f"账户{owner}的输出目录是账户{account['name']}的输入目录: {account['input_dir']}")
+    return accounts
+
+def _batch_worker_init():
+    """批处理子进程初始化：屏蔽逐文件的详细输出，进度和结果由主进程汇总"""
+    sys.stdout = open(os.devnull, 'w', encoding='utf-8')
+
+def _batch_read_task(file_path, source):
+    """批处理读取任务，返回(账单, 问题记录, 耗时)"""
+    started = time.perf_counter()
+    quarantine = []
+    reader = read_wechat_bill if source == '微信' else read_alipay_bill
+    df = reader(file_path, quarantine)
+    return df, quarantine, time.perf_counter() - started
+
+def _batch_export_task(month, month_df, output_dir, stats):
+    """批处理导出任务，month为None时导出总账单，返回(文件路径, 耗时)"""
+    started = time.perf_counter()
+    if month is None:
+        output_file = save_single_file(month_df, output_dir)
+    else:
+        output_file = save_month_file(month, month_df, output_dir, stats)
+    return output_file, time.perf_counter() - started
+
+def _batch_merge_task(account, frames, quarantine):
+    """批处理合并任务：写出问题记录，规范化、合并、对账并验证单个账户的账单
+
+    返回(问题记录文件, 合并账单, 验证结果, 耗时)，没有可合并的数据时合并账单为None。
+    """
+    started = time.perf_counter()
+    wechat_df = pd.concat(frames['微信'], ignore_index=True) if frames['微信'] else None
+    alipay_df = pd.concat(frames['支付宝'], ignore_index=True) if frames['支付宝'] else None
+    
+    os.makedirs(account['output_dir'], exist_ok=True)
+    quarantine_file = write_quarantine(quarantine, account['output_dir'])
+    # 每个账户使用独立的规范化索引；配置了缓存文件时，缓存保存在各账户的输出目录中
+    cache_file = CONFIG['counterparty']['cache_file']
+    if cache_file:
+        cache_file = os.path.join(account['output_dir'], os.path.basename(cache_file))
+    normalize_counterparties(create_counterparty_index(cache_file), wechat_df, alipay_df, cache_file=cache_file)
+    merged_df = merge_bills(wechat_df, alipay_df)
+    if merged_df is None:
+        return quarantine_file, None, None, time.perf_counter() - started
+    if CONFIG['reconcile']['enabled']:
+        reconcile_transactions(merged_df)
+        attach_export_stats(merged_df)
+    is_valid = validate_merge_integrity(wechat_df, alipay_df, merged_df)
+    return quarantine_file, merged_df, is_valid, time.perf_counter() - started
+
+def _batch_export_tasks(account, merged_df):
+    """生成单个账户的导出任务列表"""
+    if account['export_mode'] == 'single':
+        return [(_batch_export_task, (None, merged_df, account['output_dir'], None))]
+    stats_by_month = merged_df.attrs['export_stats']['by_month']
+    return [(_batch_export_task, (month, month_df, account['output_dir'], stats_by_month.get(month)))
+            for month, month_df in month_slices(merged_df) if month is not None]
+
+def run_batch(accounts, workers=None):
+    """批处理多个账户：所有读取、合并和导出任务共用一个进程池
+
+    各账户的任务分别排队，按账户轮流提交，进程池中同时执行的任务数受限，
+    因此任务较多的账户不会阻塞其他账户。账户的全部文件读取完成后，合并任务排在该账户队列最前面；
+    主进程只负责调度。读取结果、合并账单和各月数据在主进程与子进程之间传递时需要序列化，
+    这部分开销随数据量增长，不随进程数减少。返回每个账户的报告记录。
+    """
+    # 进程池只在批处理时使用，不在导入时加载multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    
+    states = []
+    for account in accounts:
+        wechat_files, alipay_files = find_bill_files(account['input_dir'])
+        files = [(file, '微信') for file in wechat_files] + [(file, '支付宝') for file in alipay_files]
+        states.append({
+            'account': account,
+            'tasks': deque((_batch_read_task, item) for item in files),
+            'reads_left': len(files),
+            'exports_left': 0,
+            'files': len(files),
+            'frames': {'微信': [], '支付宝': []},
+            'frames_read': 0,
+            'merge_failed': False,
+            'quarantine': [],
+            'read_seconds': 0.0,
+            'merge_seconds': 0.0,
+            'export_seconds': 0.0,
+            'outputs': [],
+            'export_errors': 0,
+            'records': 0,
+            'is_valid': None,
+            'quarantine_file': None,
+            'finished_at': None
+        })
+    
+    def finish_reads(state):
+        # 读取完成后优先提交该账户的合并任务
+        state['tasks'].appendleft((_batch_merge_task, (state['account'], state['frames'], state['quarantine'])))
+        state['frames'] = None
+    
+    def finish_merge(state, result):
+        quarantine_file, merged_df, is_valid, elapsed = result
+        state['merge_seconds'] = elapsed
+        state['quarantine_file'] = quarantine_file
+        state['is_valid'] = is_valid
+        state['records'] = 0 if merged_df is None else len(merged_df)
+        tasks = [] if merged_df is None else _batch_export_tasks(state['account'], merged_df)
+        state['tasks'].extend(tasks)
+        state['exports_left'] = len(tasks)
+        print(f"[{state['account']['name']}] 合并完成: {state['files']}个文件，{state['records']}条记录，"
+              f"{len(tasks)}个导出任务")
+        if not tasks:
+            state['finished_at'] = time.perf_counter() - started
+    
+    for state in states:
+        if state['reads_left'] == 0:
+            finish_reads(state)
+    
+    in_flight = {}
+    max_in_flight = workers * 2
+    turn = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_batch_worker_init) as executor:
+        while True:
+            # 按账户轮流提交任务，直到进程池排满
+            while len(in_flight) < max_in_flight:
+                ready = [i for i in range(len(states)) if states[(turn + i) % len(states)]['tasks']]
+                if not ready:
+                    break
+                state = states[(turn + ready[0]) % len(states)]
+                turn = (turn + ready[0] + 1) % len(states)
+                func, args = state['tasks'].popleft()
+                in_flight[executor.submit(func, *args)] = (state, func, args)
+            
+            if not in_flight:
+                break
+            
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                state, func, args = in_flight.pop(future)
+                if func is _batch_read_task:
+                    try:
+                        df, quarantine, elapsed = future.result()
+                    except Exception as e:
+                        df, quarantine, elapsed = None, [], 0.0
+                        add_quarantine(quarantine, args[0], [None], f'文件读取失败: {e}', [''])
+                    state['read_seconds'] += elapsed
+                    state['quarantine'].extend(quarantine)
+                    if df is not None:
+                        state['frames'][args[1]].append(df)
+                        state['frames_read'] += 1
+                    state['reads_left'] -= 1
+                    if state['reads_left'] == 0:
+                        finish_reads(state)
+                elif func is _batch_merge_task:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"[{state['account']['name']}] 合并出错: {e}")
+                        state['merge_failed'] = True
+                        result = None, None, None, 0.0
+                    finish_merge(state, result)
+                else:
+                    try:
+                        output_file, elapsed = future.result()
+                    except Exception as e:
+                        print(f"[{state['account']['name']}] 导出出错: {e}")
+                        output_file, elapsed = None, 0.0
+                    state['export_seconds'] += elapsed
+                    if output_file:
+                        state['outputs'].append(output_file)
+                    else:
+                        state['export_errors'] += 1
+                    state['exports_left'] -= 1
+                    if state['exports_left'] == 0:
+                        state['finished_at'] = time.perf_counter() - started
+    
+    report = []
+    for state in states:
+        quarantine_count = sum(len(table) for table in state['quarantine'])
+        if state['files'] and not state['frames_read']:
+            status = '读取失败'
+        elif state['merge_failed']:
+            status = '合并失败'
+        elif state['is_valid'] is None:
+            status = '无数据'
+        elif state['export_errors']:
+            status = f"{state['export_errors']}个文件导出失败"
+        elif not state['is_valid']:
+            status = '数据不一致'
+        else:
+            status = '成功'
+        report.append({
+            '账户': state['account']['name'],
+            '输入目录': state['account']['input_dir'],
+            '输出目录': state['account']['output_dir'],
+            '账单文件数': state['files'],
+            '记录数': state['records'],
+            '导出文件数': len(state['outputs']),
+            '问题记录数': quarantine_count,
+            '完整性验证': {True: '通过', False: '未通过'}.get(state['is_valid'], '-'),
+            '读取耗时(秒)': round(state['read_seconds'], 3),
+            '合并耗时(秒)': round(state['merge_seconds'], 3),
+            '导出耗时(秒)': round(state['export_seconds'], 3),
+            '完成时间(秒)': round(state['finished_at'] or 0.0, 3),
+            '状态': status
+        })
+    return report, time.perf_counter() - started
+
+def batch_main(manifest_path, workers=None, report_path=None):
+    """批处理入口：按清单处理多个账户，输出汇总的耗时与完整性报告"""
+    try:
+        accounts = load_batch_manifest(manifest_path)
+    except (OSError, ValueError) as e:
+        print(f"读取批处理清单出错 {manifest_path}: {e}")
+        return 1
+    
+    missing = [account['name'] for account in accounts if not os.path.isdir(account['input_dir'])]
+    if missing:
+        print(f"以下账户的输入目录不存在: {', '.join(missing)}")
+        return 1
+    
+    workers = workers or os.cpu_count() or 1
+    print(f"批处理账户: {len(accounts)}个，进程数: {workers}")
+    report, elapsed = run_batch(accounts, workers)
+    
+    report_df = pd.DataFrame(report)
+    if report_path is None:
+        report_path = os.path.join(os.path.dirname(os.path.abspath(manifest_path)), '批处理报告.csv')
+    report_df.to_csv(report_path, index=False, encoding='utf-8-sig')
+    
+    print("\n=== 批处理报告 ===")
+    for row in report:
+        print(f"  {row['账户']}: {row['状态']}，记录{row['记录数']}条，导出{row['导出文件数']}个文件，"
+              f"问题记录{row['问题记录数']}条，完成于{row['完成时间(秒)']:.2f}秒")
+    print(f"\n总耗时: {elapsed:.2f}秒，报告已保存: {report_path}")
+    
+    return 0 if all(row['状态'] in ('成功', '无数据') for row in report) else 1
+
 def main():
     """主函数"""
     # 获取当前目录
@@ -715,6 +1671,9 @@ def main():
         print("\n未找到任何账单文件！")
         return
     
+    # 等待用户选择时在后台导入依赖；只有支付宝账单时无需加载openpyxl
+    preload_modules(need_excel_reader=bool(wechat_files))
+    
     # 账单导出方式选择
     print("\n账单导出方式：")
     print("1  按月份分开导出（直接按回车键） / 2  所有月份合并导出（输入'2'后按回车键）")
@@ -727,10 +1686,32 @@ def main():
     else:
         user_choice = ''  # 默认为按月份导出（直接回车）
     
+    # 问题记录隔离表，读取完成后统一写出
+    quarantine = []
+    
+    if CONFIG['pipeline']['enabled']:
+        # 流水线模式：账单在读取过程中即按月写出，合并完整性在全部完成后验证
+        wechat_df, alipay_df, merged_df, _ = run_pipeline(wechat_files, alipay_files, current_dir,
+                                                          by_month=user_choice.strip() == '',
+                                                          quarantine=quarantine)
+        write_quarantine(quarantine, current_dir)
+        if merged_df is None:
+            print("\n没有可合并的数据")
+            return
+        
+        is_valid = validate_merge_integrity(wechat_df, alipay_df, merged_df)
+        if is_valid:
+            print("\n✅ 账单合并处理完成！")
+            print("📊 合并结果已验证，数据完全一致")
+        else:
+            print("\n⚠️  合并数据存在不一致，账单文件已写出，请仔细检查数据！")
+        print("💾 账单文件已保存到当前目录")
+        return
+    
     # 读取微信账单
     wechat_df_list = []
     for file in wechat_files:
-        df = read_wechat_bill(file)
+        df = read_wechat_bill(file, quarantine)
         if df is not None:
             wechat_df_list.append(df)
     
@@ -745,7 +1726,7 @@ def main():
     # 读取支付宝账单
     alipay_df_list = []
     for file in alipay_files:
-        df = read_alipay_bill(file)
+        df = read_alipay_bill(file, quarantine)
         if df is not None:
             alipay_df_list.append(df)
     
@@ -757,12 +1738,22 @@ def main():
         alipay_df = None
         print("未读取到支付宝账单数据")
     
+    write_quarantine(quarantine, current_dir)
+    
+    # 规范化交易对方
+    cache_file = CONFIG['counterparty']['cache_file']
+    normalize_counterparties(create_counterparty_index(cache_file), wechat_df, alipay_df, cache_file=cache_file)
+    
     # 合并账单
     merged_df = merge_bills(wechat_df, alipay_df)
     
     if merged_df is not None:
+        if CONFIG['reconcile']['enabled']:
+            reconcile_transactions(merged_df)
+            attach_export_stats(merged_df)
+        
         print(f"\n合并后总记录数: {len(merged_df)}")
-        print(f"涉及月份: {sorted(merged_df['月份'].unique())}")
+        print(f"涉及月份: {sorted(m for m in merged_df['月份'].unique() if m is not None)}")
         
         # 验证合并完整性
         is_valid = validate_merge_integrity(wechat_df, alipay_df, merged_df)
@@ -798,34 +1789,6 @@ def main():
         else:
             save_single_file(merged_df, current_dir)
         
-        if not is_valid:
-            print("\n⚠️  合并数据存在不一致，请检查！")
-            confirm_continue = input("是否继续保存文件？(y/n，直接回车确认): ")
-            if confirm_continue.strip().lower() != '' and confirm_continue.lower() != 'y':
-                print("保存操作已取消")
-                return
-            else:
-                print("\n⚠️  虽然数据不一致，但您选择继续保存文件")
-                # 根据用户选择保存文件
-                if export_choice.strip() == '':
-                    save_by_month(merged_df, current_dir)
-                else:
-                    save_single_file(merged_df, current_dir)
-                print("\n✅ 账单合并处理完成（但数据验证存在问题）！")
-                print("📊 合并结果验证发现问题，请仔细检查数据")
-                print("💾 账单文件已保存到当前目录")
-                print("🎨 已应用首行冻结、筛选功能、日期格式和会计专用格式")
-                print("💰 收支金额列已添加，SUBTOTAL公式已计算")
-                print("📋 交易状态已标准化，时间已按月份排序")
-                print("\n请在Excel中打开文件并仔细检查数据！")
-                return
-        
-        # 根据用户选择保存文件
-        if export_choice.strip() == '':
-            save_by_month(merged_df, current_dir)
-        else:
-            save_single_file(merged_df, current_dir)
-        
         # 只有验证通过才显示成功消息
         print("\n✅ 账单合并处理完成！")
         print("📊 合并结果已验证，数据完全一致")
@@ -839,4 +1802,14 @@ def main():
 
 
 if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='合并微信和支付宝账单')
+    parser.add_argument('--batch', metavar='MANIFEST', help='批处理清单（JSON），按清单处理多个账户')
+    parser.add_argument('--workers', type=int, default=None, help='批处理进程数，默认为CPU核心数')
+    parser.add_argument('--report', default=None, help='批处理报告路径，默认为清单所在目录下的"批处理报告.csv"')
+    args = parser.parse_args()
+    
+    if args.batch:
+        sys.exit(batch_main(args.batch, args.workers, args.report))
     main()
\ No newline at end of file